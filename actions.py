@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from collections import OrderedDict
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+# Lower runs first. Anything not listed is in between.
+PRIORITIES = {
+    'spam': 0,
+    'remove': 0,
+    'approve': 1,
+    'report': 1,
+    'linkflair': 2,
+    'upvote': 2,
+    'respond': 3,
+    'messageauthor': 4,
+    'messagemods': 4,
+}
+DEFAULT_PRIORITY = 2
+
+# Actions which don't talk to reddit, and so are performed right away
+LOCAL_ACTIONS = ('log', 'beep', 'bell', 'none', 'null', 'ignore')
+
+# Number of api requests an action makes, if not one
+COSTS = {}
+
+# Actions which post something. Reddit may have posted it even though the
+# request failed, so these are never retried.
+ONCE = ('respond', 'messageauthor', 'messagemods')
+
+
+def action_name(action):
+    """Get the name of an action, without any arguments"""
+    return action.strip().lower().split(':', 1)[0]
+
+
+class TokenBucket(object):
+    """Allows rate requests per second on average, and up to burst at once"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Wait until tokens are available, and take them"""
+        tokens = min(tokens, self.burst)
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class Job(object):
+    """Something to do which talks to reddit: calling function with args,
+    which takes cost tokens from the bucket, and is retried up to retries
+    times"""
+    __slots__ = ('priority', 'cost', 'description', 'function', 'args',
+                 'retries', 'attempts')
+
+    def __init__(self, priority, cost, description, function, args,
+                 retries):
+        self.priority = priority
+        self.cost = cost
+        self.description = description
+        self.function = function
+        self.args = args
+        self.retries = retries
+        self.attempts = 0
+
+
+class ActionExecutor(object):
+    """
+    Performs actions in a separate thread, so slow api calls don't hold up
+    checking other things.
+
+    Actions are performed by calling perform(thing, action, rule, matches),
+    most urgent first (removals before messages), no faster than the token
+    bucket allows, taking the number of tokens in costs (COSTS by default)
+    for each. An action which fails is retried up to retries times (unless
+    it's in ONCE), waiting backoff seconds and doubling that every time. The
+    same action from the same rule is only ever performed once per thing.
+    Other requests to reddit can be queued with call().
+    """
+
+    def __init__(self, perform, rate=0.5, burst=5, retries=3, backoff=5.0,
+                 remember=100000, costs=None):
+        self.perform = perform
+        self.bucket = TokenBucket(rate, burst)
+        self.costs = COSTS if costs is None else costs
+        self.retries = retries
+        self.backoff = backoff
+        self.remember = remember
+        self.stats = dict.fromkeys(('queued', 'performed', 'retried', 'failed',
+                                    'duplicates'), 0)
+        self._ready = []
+        self._delayed = []
+        self._keys = OrderedDict()
+        self._counter = itertools.count()
+        self._busy = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="actions")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, thing, action, rule, matches):
+        """Queue an action, or perform it right away if it's local"""
+        name = action_name(action)
+        if name in LOCAL_ACTIONS:
+            self.perform(thing, action, rule, matches)
+            return
+        key = (thing.name, rule['_filename'], action.strip().lower())
+        with self._cond:
+            if key in self._keys:
+                self.stats['duplicates'] += 1
+                return
+            self._keys[key] = True
+            while len(self._keys) > self.remember:
+                self._keys.popitem(last=False)
+            self._push(Job(PRIORITIES.get(name, DEFAULT_PRIORITY),
+                           self.costs.get(name, 1), "%s on %s from %s" % (
+                               action.strip(), thing.name, rule['_filename']),
+                           self.perform, (thing, action, rule, matches),
+                           0 if name in ONCE else self.retries))
+
+    def call(self, description, function, args=(), priority=DEFAULT_PRIORITY,
+             cost=1, retry=True):
+        """Queue a call of function with args, which makes cost requests to
+        reddit, and is retried if it fails unless retry is False"""
+        with self._cond:
+            self._push(Job(priority, cost, description, function, args,
+                           self.retries if retry else 0))
+
+    def _push(self, job):
+        heapq.heappush(self._ready, (job.priority, next(self._counter), job))
+        self.stats['queued'] += 1
+        self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._ready) + len(self._delayed) + int(self._busy)
+
+    def drain(self, timeout=None):
+        """Wait until all queued actions have been performed or given up on,
+        or timeout seconds have passed"""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.pending():
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                while self._delayed and self._delayed[0][0] <= now:
+                    due, count, job = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (job.priority, count, job))
+                if self._ready:
+                    self._busy = True
+                    return heapq.heappop(self._ready)[2]
+                if self._delayed:
+                    self._cond.wait(self._delayed[0][0] - now)
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            job = self._next()
+            if job.cost > 0:
+                self.bucket.acquire(job.cost)
+            try:
+                job.function(*job.args)
+                self.stats['performed'] += 1
+            except Exception, e:
+                job.attempts += 1
+                if job.attempts > job.retries:
+                    logging.error("Giving up %s: %s" % (job.description, e))
+                    self.stats['failed'] += 1
+                else:
+                    delay = self.backoff * 2 ** (job.attempts - 1)
+                    logging.warning("Failed %s, retrying in %.1f s: %s" % (
+                        job.description, delay, e))
+                    self.stats['retried'] += 1
+                    with self._cond:
+                        heapq.heappush(self._delayed, (time.time() + delay,
+                                                       next(self._counter),
+                                                       job))
+            with self._cond:
+                self._busy = False
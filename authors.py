@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from collections import OrderedDict
+from snapshot import AuthorSnapshot
+import json
+import logging
+import os
+import threading
+import time
+
+
+class AuthorProfile(object):
+    """The parts of a Redditor that rules need, and when they were fetched"""
+    __slots__ = ('name', 'created_utc', 'karma', 'fetched')
+
+    def __init__(self, name, created_utc, karma, fetched):
+        self.name = name
+        self.created_utc = created_utc
+        self.karma = karma
+        self.fetched = fetched
+
+
+class ProfileUnavailable(Exception):
+    """Raised when the profile of an author isn't cached and can't be
+    fetched, like when replaying a corpus which doesn't have it"""
+
+
+class AuthorCache(object):
+    """
+    Process-wide cache of author profiles, keyed by username.
+
+    Looking at the age or karma of a Redditor makes praw fetch the user from
+    the api, once for every item, so this keeps the profiles around for ttl
+    seconds, holding at most size of them (evicting the least recently used).
+    If a filename is configured the cache can be saved to and loaded from it.
+    """
+
+    def __init__(self, ttl=3600, size=10000, filename=None):
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.unavailable = 0
+        # Called with every profile fetched from reddit
+        self.on_fetch = None
+        # Called with a username to fetch the Redditor, if set. Otherwise
+        # the Redditor given to get() has to fetch itself.
+        self.fetch = None
+        self.configure(ttl, size, filename)
+
+    def configure(self, ttl, size, filename=None):
+        self.ttl = ttl
+        self.size = size
+        self.filename = filename
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def get(self, redditor):
+        """Get the profile of redditor (or anything with a name, like an
+        AuthorSnapshot), fetching it from reddit if it isn't cached or has
+        expired. Without fetch, an AuthorSnapshot can't fetch itself, so
+        ProfileUnavailable is raised."""
+        name = redditor.name
+        key = name.lower()
+        now = time.time()
+        with self._lock:
+            profile = self._profiles.pop(key, None)
+            if profile is not None and now - profile.fetched < self.ttl:
+                self._profiles[key] = profile
+                self.hits += 1
+                return profile
+            self.misses += 1
+        if self.fetch is not None:
+            redditor = self.fetch(name)
+        elif isinstance(redditor, AuthorSnapshot):
+            # Only has the name
+            self.unavailable += 1
+            raise ProfileUnavailable("No profile of %s" % name)
+        profile = AuthorProfile(name, redditor.created_utc,
+                                redditor.link_karma + redditor.comment_karma,
+                                now)
+        self.put(profile)
+        if self.on_fetch is not None:
+            self.on_fetch(profile)
+        return profile
+
+    def peek(self, name):
+        """Get the profile of name if it's cached and hasn't expired, without
+        fetching it or counting it as a hit or miss"""
+        with self._lock:
+            profile = self._profiles.get(name.lower())
+        if profile is not None and time.time() - profile.fetched < self.ttl:
+            return profile
+        return None
+
+    def put(self, profile):
+        """Add a profile to the cache"""
+        with self._lock:
+            key = profile.name.lower()
+            self._profiles.pop(key, None)
+            self._profiles[key] = profile
+            while len(self._profiles) > self.size:
+                self._profiles.popitem(last=False)
+                self.evictions += 1
+            self._dirty = True
+
+    def stats(self):
+        return {'size': len(self._profiles), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'unavailable': self.unavailable}
+
+    def load(self):
+        """Read the profiles saved in the cache file, skipping expired ones"""
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                profiles = json.load(f)
+        except Exception, e:
+            logging.warning("Failed reading author cache %s: %s" % (
+                self.filename, e))
+            return
+        now = time.time()
+        for name, created_utc, karma, fetched in profiles:
+            if now - fetched < self.ttl:
+                self.put(AuthorProfile(name, created_utc, karma, fetched))
+        self._dirty = False
+        logging.info("Read %d authors from %s" % (len(self), self.filename))
+
+    def save(self):
+        """Write the profiles to the cache file, if anything changed"""
+        if self.filename is None or not self._dirty:
+            return
+        with self._lock:
+            profiles = [(p.name, p.created_utc, p.karma, p.fetched)
+                        for p in self._profiles.itervalues()]
+            self._dirty = False
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(profiles, f)
+        os.rename(tmpname, self.filename)
+
+
+AUTHOR_CACHE = AuthorCache()
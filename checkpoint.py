@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS things (
+    list TEXT NOT NULL,
+    fullname TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    PRIMARY KEY (list, fullname)
+);
+CREATE INDEX IF NOT EXISTS things_timestamp ON things (list, timestamp);
+CREATE TABLE IF NOT EXISTS cursors (
+    stream TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# How often to delete expired things from the database
+COMPACT_INTERVAL = 3600
+
+
+class Checkpoint(object):
+    """
+    Durable record of the things which have been checked or acted on, and of
+    the position in each stream, kept in an SQLite database in WAL mode.
+
+    Writes are buffered and only written, in a single transaction, when
+    commit() is called - normally once per loop. Things older than max_age
+    are deleted periodically, so the database doesn't keep growing.
+    """
+
+    def __init__(self, filename, max_age):
+        self.filename = filename
+        self.max_age = max_age
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._things = []
+        self._cursors = {}
+        self._compacted = 0
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+    def remember(self, listname, fullname, timestamp):
+        """Record that fullname was added to listname at timestamp"""
+        with self._lock:
+            self._things.append((listname, fullname, timestamp))
+
+    def things(self, listname, since=0):
+        """Get (fullname, timestamp) of the things in listname added since the
+        given time, oldest first"""
+        return self._db.execute("SELECT fullname, timestamp FROM things "
+                                "WHERE list = ? AND timestamp >= ? "
+                                "ORDER BY timestamp", (listname, since))
+
+    def set_cursor(self, stream, value):
+        with self._lock:
+            self._cursors[stream] = value
+
+    def cursor(self, stream):
+        """Get the last committed position in stream, or None"""
+        with self._lock:
+            if stream in self._cursors:
+                return self._cursors[stream]
+        row = self._db.execute("SELECT value FROM cursors WHERE stream = ?",
+                               (stream,)).fetchone()
+        return row[0] if row is not None else None
+
+    def commit(self):
+        """Write everything recorded since the last commit"""
+        with self._lock:
+            things, self._things = self._things, []
+            cursors, self._cursors = self._cursors, {}
+        if things or cursors:
+            with self._db:
+                self._db.executemany("INSERT OR IGNORE INTO things "
+                                     "(list, fullname, timestamp) "
+                                     "VALUES (?, ?, ?)", things)
+                self._db.executemany("INSERT OR REPLACE INTO cursors "
+                                     "(stream, value) VALUES (?, ?)",
+                                     cursors.iteritems())
+        if time.time() - self._compacted > COMPACT_INTERVAL:
+            self.compact()
+
+    def compact(self):
+        """Delete things older than max_age"""
+        self._compacted = time.time()
+        with self._db:
+            deleted = self._db.execute("DELETE FROM things "
+                                       "WHERE timestamp < ?",
+                                       (int(self._compacted - self.max_age),)
+                                       ).rowcount
+        if deleted:
+            logging.info("Deleted %d expired things from %s" % (
+                deleted, self.filename))
+
+    def import_list(self, listname, filename):
+        """Import an old style list file of "fullname,timestamp" lines, and
+        rename it so it's only imported once"""
+        if not os.path.exists(filename):
+            return
+        with open(filename) as f:
+            for line in f:
+                fullname, timestamp = line.strip().split(",")
+                self.remember(listname, fullname, int(timestamp))
+        self.commit()
+        os.rename(filename, filename + '.imported')
+        logging.info("Imported %s into %s" % (filename, self.filename))
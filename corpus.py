@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from authors import AuthorProfile
+from praw.objects import Redditor, Subreddit
+from snapshot import ThingSnapshot, make_snapshot
+import json
+import random
+import threading
+import time
+
+
+def thing_record(stream, thing):
+    """Get the JSON-able data of a thing as fetched from a listing"""
+    if isinstance(thing, ThingSnapshot):
+        return {'stream': stream, 'kind': thing.name.split('_', 1)[0],
+                'data': thing.data()}
+    data = {}
+    for key, value in vars(thing).iteritems():
+        if key.startswith('_') or key == 'reddit_session':
+            continue
+        if isinstance(value, Redditor):
+            value = value.name
+        elif isinstance(value, Subreddit):
+            value = value.display_name
+        elif not isinstance(value, (basestring, int, long, float, bool,
+                                    type(None))):
+            continue
+        data[key] = value
+    return {'stream': stream, 'kind': thing.name.split('_', 1)[0],
+            'data': data}
+
+
+def make_thing(record):
+    """Turn a record back into a ThingSnapshot"""
+    return make_snapshot(record['kind'], record['data'])
+
+
+def read_corpus(filename):
+    """Read a corpus file. Returns a list of (stream, thing) in the order
+    they were recorded, and a list of AuthorProfiles"""
+    things = []
+    authors = []
+    for line in open(filename):
+        record = json.loads(line)
+        if record['kind'] == 'author':
+            authors.append(AuthorProfile(record['name'],
+                                         record['created_utc'],
+                                         record['karma'], time.time()))
+        else:
+            things.append((record['stream'], make_thing(record)))
+    return things, authors
+
+
+class Recorder(object):
+    """Writes fetched things and author profiles to a corpus file, one JSON
+    object per line, for replaying later"""
+
+    def __init__(self, filename):
+        self._file = open(filename, 'a')
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def things(self, stream, things):
+        for thing in things:
+            self._write(thing_record(stream, thing))
+
+    def author(self, profile):
+        self._write({'kind': 'author', 'name': profile.name,
+                     'created_utc': profile.created_utc,
+                     'karma': profile.karma})
+
+
+WORDS = ("the be to of and a in that have it for not on with he as you do at "
+         "this but his by from they we say her she or an will my one all "
+         "would there their what so up out if about who get which go me when "
+         "make can like time no just him know take people into year your "
+         "good some could them see other than then now look only come its "
+         "over think also back after use two how our work first well way "
+         "even new want because any these give day most us").split()
+DOMAINS = ['imgur.com', 'i.imgur.com', 'youtube.com', 'reddit.com',
+           'nytimes.com', 'bbc.co.uk', 'quickmeme.com', 'example.com']
+
+
+SPAMWORDS = ['viagra', 'casino', 'bitcoins', 'followme', 'freegift']
+
+
+def _text(rng, length, spamwords):
+    words = [rng.choice(WORDS) for i in xrange(length)]
+    if spamwords and rng.random() < 0.02:
+        words[rng.randrange(length)] = rng.choice(spamwords)
+    return ' '.join(words)
+
+
+def generate(filename, comments=10000, submissions=1000, authors=2000,
+             subreddit='test', seed=0, spamwords=SPAMWORDS):
+    """Write a synthetic corpus, with comments and submissions interleaved
+    as they would arrive. Body lengths are skewed like real comments, and
+    about 2% of texts contain one of the spamwords."""
+    rng = random.Random(seed)
+    now = int(time.time())
+    names = ['user%d' % i for i in xrange(authors)]
+    with open(filename, 'w') as f:
+        for name in names:
+            f.write(json.dumps({
+                'kind': 'author', 'name': name,
+                'created_utc': now - int(rng.expovariate(1.0 / 400) * 86400),
+                'karma': int(rng.expovariate(1.0 / 2000))}) + "\n")
+        total = comments + submissions
+        for i in xrange(total):
+            created = now - (total - i)
+            score = int(rng.expovariate(0.2))
+            data = {'id': '%x' % (i + 1), 'author': rng.choice(names),
+                    'subreddit': subreddit, 'created_utc': created,
+                    'ups': score + 1, 'downs': 1, 'score': score,
+                    'num_reports': rng.choice([0] * 20 + [1, 2])}
+            if rng.random() < comments / float(total):
+                kind, stream = 't1', 'comments'
+                data['body'] = _text(rng, int(rng.lognormvariate(3, 1)) + 1,
+                                     spamwords)
+            else:
+                kind, stream = 't3', 'submissions'
+                data['title'] = _text(rng, rng.randint(3, 15), spamwords)
+                data['domain'] = rng.choice(DOMAINS)
+                data['url'] = 'http://%s/%d' % (data['domain'], i)
+                data['selftext'] = ''
+                if rng.random() < 0.3:
+                    data['domain'] = 'self.' + subreddit
+                    data['selftext'] = _text(
+                        rng, int(rng.lognormvariate(4, 1)) + 1, spamwords)
+            data['name'] = '%s_%s' % (kind, data['id'])
+            data['permalink'] = 'http://www.reddit.com/r/%s/%s' % (
+                subreddit, data['id'])
+            f.write(json.dumps({'stream': stream, 'kind': kind,
+                                'data': data}) + "\n")
@@ -6,6 +6,10 @@ class RequiresType(object):
     Checks that the first (or position given by the keyword argument 'position'
     argument to the function is an instance of one of the types given in the
     positional decorator arguments
+
+    The types and the undecorated function are available as the attributes
+    types and function of the decorated function, so callers which already
+    know the type can check it once and skip the check.
     """
 
     def __init__(self, *types, **kwargs):
@@ -17,9 +21,11 @@ class RequiresType(object):
     def __call__(self, f):
         def wrapped_f(*args, **kwargs):
             if type(args[self.position]) not in self.types:
-                raise TypeError("Invalid argument type '%s' at position %d. " + 
-                        "Expected one of (%s)" % (
+                raise TypeError(("Invalid argument type '%s' at position %d. "
+                        "Expected one of (%s)") % (
                             type(args[self.position]).__name__, self.position,
                             ", ".join([t.__name__ for t in self.types])))
             return f(*args, **kwargs)
+        wrapped_f.types = self.types
+        wrapped_f.function = f
         return wrapped_f
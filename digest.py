@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from os import path
+import logging
+import threading
+import time
+
+# Longest message reddit accepts
+MAX_LENGTH = 10000
+
+
+class Digest(object):
+    """The messages for one target from one rule, waiting to be sent"""
+
+    def __init__(self, target, rule, subject):
+        self.target = target
+        self.rule = rule
+        self.subject = subject
+        self.texts = []
+        self.length = 0
+        self.started = time.time()
+
+
+class Digests(object):
+    """
+    Collects messagemods messages per target subreddit and rule, and sends
+    them as one message when count of them have been collected, or window
+    seconds after the first one, whichever comes first.
+
+    Messages are sent by calling send(target, subject, text). modbot makes
+    that queue a job on the ActionExecutor, so digests are rate limited like
+    actions and sending them doesn't hold up checking.
+    """
+    SEPARATOR = u"\n\n***\n\n"
+
+    def __init__(self, send, window=600, count=20):
+        self.send = send
+        self.window = window
+        self.count = count
+        self.stats = dict.fromkeys(('messages', 'sent'), 0)
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def add(self, target, rule, subject, text):
+        """Add a message for target from rule to its digest, sending it if
+        it's full"""
+        key = (target.display_name.lower(), rule['_filename'])
+        full = []
+        with self._lock:
+            self.stats['messages'] += 1
+            digest = self._digests.get(key)
+            if (digest is not None and digest.length + len(self.SEPARATOR) +
+                    len(text) > MAX_LENGTH):
+                full.append(self._digests.pop(key))
+                digest = None
+            if digest is None:
+                digest = self._digests[key] = Digest(target, rule, subject)
+            digest.texts.append(text)
+            digest.length += len(text) + len(self.SEPARATOR)
+            if len(digest.texts) >= self.count:
+                full.append(self._digests.pop(key))
+        for digest in full:
+            self._send(digest)
+
+    def flush(self, everything=False):
+        """Send the digests whose window has passed, or all of them"""
+        now = time.time()
+        with self._lock:
+            due = [key for key, digest in self._digests.iteritems()
+                   if everything or now - digest.started >= self.window]
+            digests = [self._digests.pop(key) for key in due]
+        for digest in digests:
+            self._send(digest)
+
+    def pending(self):
+        with self._lock:
+            return sum(len(digest.texts) for digest in
+                       self._digests.itervalues())
+
+    def _send(self, digest):
+        subject = digest.subject
+        if len(digest.texts) > 1:
+            subject = u"%s (%d items)" % (subject[:80], len(digest.texts))
+        logging.info("Send digest of %d messages from %s to %s" % (
+            len(digest.texts), path.basename(digest.rule['_filename']),
+            digest.target.display_name))
+        try:
+            self.send(digest.target, subject,
+                      self.SEPARATOR.join(digest.texts)[:MAX_LENGTH])
+            self.stats['sent'] += 1
+        except Exception, e:
+            logging.error("Failed sending digest of %d messages to %s: %s" % (
+                len(digest.texts), digest.target.display_name, e))
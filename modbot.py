@@ -28,53 +28,134 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from datetime import datetime
+from actions import ActionExecutor, TokenBucket, LOCAL_ACTIONS, action_name
+from actions import COSTS, PRIORITIES
+from authors import AUTHOR_CACHE, ProfileUnavailable
+from checkpoint import Checkpoint
+from collections import OrderedDict
+from corpus import Recorder
+from digest import Digests
+from pipeline import Pipeline
 from pprint import pprint
+from profiler import RuleProfiler
+from recheck import Rechecker
 from praw import Reddit
-from praw.objects import Submission, Comment, Redditor
+from praw.objects import Submission, Redditor
 from rules import RuleHandler
-from decorators import RequiresType
+from scheduler import AdaptivePolicy, Scheduler
+from seenstore import SeenStore
+from snapshot import ThingSnapshot, snapshot
+from shadow import ShadowChecker
+from streams import Stream
+from templates import Template
+from values import ItemValues
+from workers import WorkerPool
 import argparse
 import logging
 import logging.config
 import os.path
 import praw.errors
-import re
 import sys
 import time
 
 NAME = "ModBot"
 VERSION = 0.1
 
-SEEN = set()
+SEEN = SeenStore()
+SEEN_LIST = 'seen'
 SEEN_FILE = 'seen.list'
 
-MODQUEUE_ACTED = set()
+# Sent if a rule has no body, or it can't be formatted
+DEFAULT_MESSAGE = Template("""
+The following post/comment by /u/{thing.author.name} matched the rule
+{rule[_filename]}: {thing.permalink}
+""".strip())
+
+# Things may stay in the modqueue for a long time
+MODQUEUE_ACTED = SeenStore(max_age=30 * 86400)
+MODQUEUE_ACTED_LIST = 'modqueue_acted'
 MODQUEUE_ACTED_FILE = 'modqueue_acted.list'
 
+# The versions of the rules the modqueue was last checked against
+MODQUEUE_VERSIONS = None
+
+# Where SEEN, MODQUEUE_ACTED and stream positions are saved, if anywhere
+CHECKPOINT = None
+
+# Performs actions in the background. If None, they're performed right away
+EXECUTOR = None
+
+# Checks things in worker processes, if not None
+POOL = None
+
+# The reddit session, for fetching things to act on
+REDDIT = None
+
+# Things fetched to act on, by fullname, in case there are more actions
+RESOLVED = OrderedDict()
+RESOLVED_SIZE = 100
+
+# The listings which are polled
+STREAMS = []
+
+# Things to check again later against rules on changing fields, if not None
+RECHECKER = None
+
+# Collects messages to the mods into digests, if not None
+DIGESTS = None
+
+# Checks things against the rules in --shadow-rulesdir too, if not None
+SHADOW = None
+
+# Times the rules and conditions if not None, see --profile
+PROFILER = None
+PROFILE_FILE = None
+
+
+def resolve(thing):
+    """Get the praw object to act on for thing, fetching it if thing is a
+    ThingSnapshot. The request counts against the action rate."""
+    if not isinstance(thing, ThingSnapshot):
+        return thing
+    resolved = RESOLVED.pop(thing.name, None)
+    if resolved is None:
+        if EXECUTOR is not None:
+            EXECUTOR.bucket.acquire()
+        resolved = REDDIT.get_info(thing_id=thing.name)
+        if resolved is None:
+            raise ValueError("%s no longer exists" % thing.name)
+        author = getattr(thing, 'author', None)
+        if hasattr(author, 'age') and resolved.author is not None:
+            resolved.author.age = author.age
+    RESOLVED[thing.name] = resolved
+    while len(RESOLVED) > RESOLVED_SIZE:
+        RESOLVED.popitem(last=False)
+    return resolved
+
 
 def performaction(thing, action, rule, matches):
     origaction = action.strip()
     action = action.strip().lower()
     logging.info("Perform %s on %s from %s" % (action, thing.permalink,
         rule['_filename']))
+    # Digested messages only need the snapshot, until the digest is sent
+    digest = DIGESTS is not None and action_name(action) == 'messagemods'
+    if action_name(action) not in LOCAL_ACTIONS and not digest:
+        thing = resolve(thing)
 
     # Compose message. All these are made the same way
     if action in ('respond', 'messagemods', 'messageauthor') or action.startswith('messagemods'):
         subject = "Modbot rule matched"
         try:
             if 'subject' in rule:
-                subject = rule['subject'].format(thing=thing, rule=rule, matches=matches)
-            text = rule['content'].format(thing=thing, rule=rule,
-                    matches=matches)
+                subject = rule.format('subject', thing=thing, rule=rule,
+                                      matches=matches)
+            text = rule.format('content', thing=thing, rule=rule,
+                               matches=matches)
         except Exception:
             # We'll just use a default message then
-            text = """
-The following post/comment by /u/{thing.author.name} matched the rule
-{rule._filename}: {thing.permalink}
-""".strip()
-            text = text.format(thing=thing, rule=rule, matches=matches)
-            pass
+            text = DEFAULT_MESSAGE.format(thing=thing, rule=rule,
+                                          matches=matches)
 
     if action == 'upvote':
         thing.upvote()
@@ -92,14 +173,24 @@ The following post/comment by /u/{thing.author.name} matched the rule
             comment = thing.add_comment(text)
         else:
             comment = thing.reply(text)
-        comment.distinguish()
+        if EXECUTOR is not None:
+            # Its own job, so a failure doesn't post the reply again
+            EXECUTOR.call("distinguish reply to %s" % thing.name,
+                          comment.distinguish,
+                          priority=PRIORITIES['respond'])
+        else:
+            comment.distinguish()
     elif action.startswith('messagemods'):
         if ':' in action:
-            sub = origaction.split(':', 1)[1]
-            target = thing.reddit_session.get_subreddit(sub)
+            target = REDDIT.get_subreddit(origaction.split(':', 1)[1])
+        elif digest:
+            target = REDDIT.get_subreddit(thing.subreddit.display_name)
         else:
             target = thing.subreddit
-        target.send_message(subject, text)
+        if digest:
+            DIGESTS.add(target, rule, subject, text)
+        else:
+            target.send_message(subject, text)
     elif action in ('beep', 'bell'):
         sys.stdout.write("\x07")
     elif action == 'messageauthor':
@@ -122,205 +213,179 @@ The following post/comment by /u/{thing.author.name} matched the rule
 
 
 def applyrule(thing, rule, matches):
-    if 'action' in rule:
-        for action in rule['action'].split(','):
-            performaction(thing, action, rule, matches)
-    if 'actions' in rule:
-        for action in rule['actions'].split(','):
-            performaction(thing, action, rule, matches)
-
-
-class ValueGetter:
-    """
-    Simplify getting a value from a thing, using a common name for different
-    types of things, regardless of how the value is retrieved.
-    """
-    @RequiresType(Submission, Comment, Redditor, position=2)
-    def username(self, thing):
-        if not isinstance(thing, Redditor):
-            thing = thing.author
-        return thing.name
-
-    @RequiresType(Submission, Comment, position=2)
-    def numreports(self, thing):
-        return thing.num_reports
-
-    @RequiresType(Submission, position=2)
-    def domain(self, thing):
-        return thing.domain
-
-    @RequiresType(Submission, position=2)
-    def title(self, thing):
-        return thing.title
-
-    @RequiresType(Submission, position=2)
-    def url(self, thing):
-        return thing.url
-
-    @RequiresType(Submission, Comment, position=2)
-    def upvotes(self, thing):
-        return thing.ups
-
-    @RequiresType(Submission, Comment, position=2)
-    def downvotes(self, thing):
-        return thing.downs
-
-    @RequiresType(Submission, Comment, position=2)
-    def score(self, thing):
-        return thing.score
-
-    def type(self, thing):
-        return type(thing).__name__.lower()
-
-    @RequiresType(Submission, Comment, position=2)
-    def body(self, thing):
-        if isinstance(thing, Comment):
-            return thing.body
-        else:
-            return thing.selftext
+    for action in rule.actions:
+        try:
+            if EXECUTOR is not None:
+                EXECUTOR.submit(thing, action, rule, matches)
+            else:
+                performaction(thing, action, rule, matches)
+        except Exception, e:
+            logging.error("Failed %s on %s from %s: %s" % (
+                action.strip(), thing.name, rule['_filename'], e))
 
-    @RequiresType(Submission, Comment, position=2)
-    def bodylength(self, thing):
-        return len(self.body(thing))
 
-    @RequiresType(Submission, Comment, position=2)
-    def dayhour(self, thing):
-        return datetime.fromtimestamp(thing.created_utc).strftime("%a-%H")
+def decorate(thing, values=None):
+    """Add the age of the author to the thing, for use in templates"""
+    if values is None:
+        values = ItemValues(thing)
+    try:
+        age = values.value('userage')
+    except (AttributeError, TypeError, ProfileUnavailable):
+        return
+    if isinstance(thing, Redditor):
+        thing.age = age
+    else:
+        thing.author.age = age
 
-    @RequiresType(Submission, Comment, Redditor, position=2)
-    def userage(self, thing):
-        if not isinstance(thing, Redditor):
-            thing = thing.author
-        created = datetime.utcfromtimestamp(thing.created_utc)
-        now = datetime.utcnow()
-        return (now - created).days
 
-    @RequiresType(Submission, Comment, Redditor, position=2)
-    def userkarma(self, thing):
-        if not isinstance(thing, Redditor):
-            thing = thing.author
-        return thing.link_karma + thing.comment_karma
+def checked(thing, is_modqueue=False):
+    """Whether thing was checked before, and shouldn't be again"""
+    if is_modqueue:
+        return thing.name in MODQUEUE_ACTED
+    return thing.name in SEEN or SEEN.maybe_forgotten(thing.created_utc)
 
 
-def decorate(thing):
-    if isinstance(thing, Redditor):
-        created = datetime.utcfromtimestamp(thing.created_utc)
-        now = datetime.utcnow()
-        thing.age = (now - created).days
-    elif isinstance(thing, Comment):
-        decorate(thing.author)
-    elif isinstance(thing, Submission):
-        decorate(thing.author)
-
-
-def rulesorter(a, b):
-    """Compares two rules for sorting, sorting simple lookups before ones
-    which require additional hits to the reddit api"""
-    order = ['type','body','bodylength','dayhour','domain','downvotes',
-            'numreports','score','title','upvotes','url','username',
-            'userkarma','userage']
-    a = a[0].replace('!', '').lower()
-    b = b[0].replace('!', '').lower()
-    if a in order and b in order:
-        return cmp(order.index(a), order.index(b))
-    elif not a in order:
-        return -1
-    elif not b in order:
-        return 1
-    else:
-        return 0
+def matchrules(thing, ruleset, is_modqueue=False, recheck=False,
+               result=None):
+    """Check thing against the rules, and act on the first matching one.
+    Things which were checked before are skipped, unless recheck is True.
+    If the thing was already matched (by a WorkerPool), the rule and
+    matches are given as result.
 
-def matchrules(thing, rules, is_modqueue=False):
-    if thing.name in SEEN and not is_modqueue:
-        return False
-    if thing.name in MODQUEUE_ACTED and is_modqueue:
+    Returns whether a rule matched"""
+    if not recheck and checked(thing, is_modqueue):
         return False
 
-    vg = ValueGetter()
-    for rule in rules:
-        logging.debug("Match %s against %s" % (thing.name, rule['_filename']))
-        ruleMatches = True
-        matches = {}
-        for key, value in sorted(rule.iteritems(), rulesorter):
-            if key in ('actions', '_filename'):
-                continue
-
-            # Allow to make negative matches by prefixing with "!"
-            invert = key[0] == "!"
-
-            try:
-                if invert:
-                    fieldvalue = unicode(getattr(vg, key[1:])(thing))
-                else:
-                    fieldvalue = unicode(getattr(vg, key)(thing))
-            except AttributeError:
-                # Ignore conditions we don't understand
-                continue
-            except TypeError:
-                ruleMatches = False
-                break
-
-            logging.debug("Match %s %s %s" % (thing.name, key, fieldvalue))
-            regex = '(?P<full>%s)' % value
-            m = re.search(regex, fieldvalue, flags=re.IGNORECASE)
-
-            if (not m and not invert) or (m and invert):
-                ruleMatches = False
-                break
-            elif m:
-                matches[key] = m.groupdict()
-        if ruleMatches:
-            try:
-                decorate(thing)
-                applyrule(thing, rule, matches)
-                seen(thing.name)
-                if is_modqueue:
-                    modqueue_acted(thing.name)
-                return True
-            except Exception, e:
-                logging.error(str(e))
-                return False
+    values = ItemValues(thing)
+    if result is None:
+        rule, matches = ruleset.match(thing, values, PROFILER)
+    else:
+        rule, matches = result
+    if SHADOW is not None and not recheck:
+        SHADOW.submit(thing, rule)
+    if rule is not None:
+        try:
+            decorate(thing, values)
+            applyrule(thing, rule, matches)
+            seen(thing.name)
+            if is_modqueue:
+                modqueue_acted(thing.name)
+            # Don't risk acting on it again after a restart
+            if CHECKPOINT is not None:
+                CHECKPOINT.commit()
+            return True
+        except Exception, e:
+            logging.error(str(e))
+            return False
     seen(thing.name)
+    if (RECHECKER is not None and not (is_modqueue or recheck) and
+            values.kind in ruleset.volatile_kinds):
+        RECHECKER.add(thing)
     return False
 
 
 def modqueue_acted(thing_id):
-    remember_thing(MODQUEUE_ACTED, MODQUEUE_ACTED_FILE, thing_id)
+    remember_thing(MODQUEUE_ACTED, MODQUEUE_ACTED_LIST, thing_id)
 
 
 def seen(thing_id):
-    remember_thing(SEEN, SEEN_FILE, thing_id)
+    remember_thing(SEEN, SEEN_LIST, thing_id)
 
 
-def remember_thing(idset, filename, thing_id):
+def remember_thing(idset, listname, thing_id):
     if thing_id in idset:
         return
-    idset.add(thing_id)
-    f = open(filename, 'a')
-    f.write("%s,%d\n" % (thing_id, int(datetime.utcnow().strftime("%s"))))
-    f.close()
+    timestamp = int(time.time())
+    idset.add(thing_id, timestamp)
+    if CHECKPOINT is not None:
+        CHECKPOINT.remember(listname, thing_id, timestamp)
+
+
+def read_thinglist(idset, listname, filename):
+    CHECKPOINT.import_list(listname, filename)
+    since = int(time.time() - idset.max_age)
+    for thing_id, timestamp in CHECKPOINT.things(listname, since):
+        idset.add(thing_id, timestamp)
 
 
 def read_thinglists():
-    if os.path.exists(SEEN_FILE):
-        for line in open(SEEN_FILE):
-            SEEN.add(line.strip().split(",")[0])
-    if os.path.exists(MODQUEUE_ACTED_FILE):
-        for line in open(MODQUEUE_ACTED_FILE):
-            MODQUEUE_ACTED.add(line.strip().split(",")[0])
+    read_thinglist(SEEN, SEEN_LIST, SEEN_FILE)
+    read_thinglist(MODQUEUE_ACTED, MODQUEUE_ACTED_LIST, MODQUEUE_ACTED_FILE)
 
 
 def main():
     parser = argparse.ArgumentParser(
             prog='modbot.py',
             description="Subreddit automoderating script")
-    parser.add_argument('subreddit')
+    parser.add_argument('subreddit', nargs='+',
+                        help="subreddits to moderate. With more than one, the "
+                        "rules for each are read from the directory in the "
+                        "rules dir named after it, if there is one")
     parser.add_argument('-r', '--rulesdir', default='./rules')
     parser.add_argument('-u', '--user')
     parser.add_argument('-p', '--password')
+    parser.add_argument('--author-ttl', type=int, default=3600,
+                        help="seconds to cache author age and karma")
+    parser.add_argument('--author-cache-size', type=int, default=10000,
+                        help="maximum number of authors to cache")
+    parser.add_argument('--author-cache-file',
+                        help="file to keep the author cache in across "
+                        "restarts")
+    parser.add_argument('--seen-days', type=float, default=3,
+                        help="days to remember which things were checked")
+    parser.add_argument('--seen-capacity', type=int, default=1000000,
+                        help="maximum number of checked things to remember")
+    parser.add_argument('--seen-bloom', action='store_true', default=False,
+                        help="remember checked things in bloom filters, using "
+                        "a fixed amount of memory but with a small chance of "
+                        "skipping a thing")
+    parser.add_argument('--checkpoint', default='modbot.db',
+                        help="database to save checked things and stream "
+                        "positions in")
+    parser.add_argument('--pipelined', action='store_true', default=False,
+                        help="fetch the modqueue, comments and submissions "
+                        "concurrently, checking them as they arrive")
+    parser.add_argument('--adaptive', action='store_true', default=False,
+                        help="adapt how often and how much of each listing "
+                        "is fetched to how busy it is")
+    parser.add_argument('--poll-budget', type=float, default=20,
+                        help="maximum requests per minute for fetching "
+                        "listings with --adaptive")
+    parser.add_argument('--record', metavar='FILE',
+                        help="record fetched listings and authors to FILE, "
+                        "for replay.py")
+    parser.add_argument('--action-rate', type=float, default=0.5,
+                        help="maximum number of actions per second")
+    parser.add_argument('--action-retries', type=int, default=3,
+                        help="times to retry a failed action")
+    parser.add_argument('--recheck-window', type=float, default=0,
+                        metavar='MINUTES',
+                        help="check things again against rules on score, "
+                        "votes or reports for MINUTES after they're posted")
+    parser.add_argument('--recheck-interval', type=float, default=10,
+                        metavar='MINUTES',
+                        help="minutes between checks with --recheck-window")
+    parser.add_argument('--digest-window', type=float, default=0,
+                        metavar='MINUTES',
+                        help="collect messages to the mods from each rule "
+                        "for up to MINUTES, and send them as one")
+    parser.add_argument('--digest-count', type=int, default=20,
+                        help="send a digest once it has this many messages")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="check things in this many processes, which "
+                        "are stopped if a rule takes too long")
+    parser.add_argument('--shadow-rulesdir', metavar='DIR',
+                        help="also check things against the rules in DIR, "
+                        "without acting on them, reporting what they would "
+                        "have done to --shadow-report")
+    parser.add_argument('--shadow-report', metavar='FILE',
+                        default='shadow.jsonl')
+    parser.add_argument('--profile', metavar='FILE',
+                        help="time the rules and their conditions, writing "
+                        "the numbers to FILE in the Prometheus text format")
     args = parser.parse_args()
 
-    rh = RuleHandler(args.rulesdir, '*.rule')
+    rulehandlers = read_rules(args.rulesdir, args.subreddit)
 
     logging.config.fileConfig('logging.conf')
 
@@ -331,66 +396,228 @@ def main():
         logging.critical("Login failure")
         sys.exit(1)
 
-    sub = reddit.get_subreddit(args.subreddit)
+    global SEEN, MODQUEUE_ACTED, CHECKPOINT, EXECUTOR, PROFILER, PROFILE_FILE
+    global RECHECKER, SHADOW, DIGESTS, STREAMS, REDDIT, POOL
+    SEEN = SeenStore(max_age=args.seen_days * 86400,
+                     capacity=args.seen_capacity, bloom=args.seen_bloom)
+    MODQUEUE_ACTED = SeenStore(max_age=max(30, args.seen_days) * 86400,
+                               capacity=args.seen_capacity,
+                               bloom=args.seen_bloom)
+    REDDIT = reddit
+    AUTHOR_CACHE.fetch = reddit.get_redditor
+    CHECKPOINT = Checkpoint(args.checkpoint, MODQUEUE_ACTED.max_age)
+    costs = dict(COSTS)
+    if args.digest_window > 0:
+        # Only adds the message to a digest, which is sent by its own job
+        costs['messagemods'] = 0
+    EXECUTOR = ActionExecutor(
+        lambda *action: performaction(*action), rate=args.action_rate,
+        retries=args.action_retries, costs=costs)
+    if args.recheck_window > 0:
+        RECHECKER = Rechecker(window=args.recheck_window * 60,
+                              interval=args.recheck_interval * 60)
+    if args.digest_window > 0:
+        DIGESTS = Digests(
+            lambda target, subject, text: EXECUTOR.call(
+                "digest to %s" % target.display_name, target.send_message,
+                (subject, text), PRIORITIES['messagemods'], retry=False),
+            window=args.digest_window * 60, count=args.digest_count)
+    if args.workers > 0 and args.profile:
+        logging.warning("Rules are only timed in the main process, ignoring "
+                        "--workers for --profile")
+    elif args.workers > 0:
+        POOL = WorkerPool(rulehandlers, args.workers)
+    if args.shadow_rulesdir:
+        shadowrules = read_rules(args.shadow_rulesdir, args.subreddit)
+        SHADOW = ShadowChecker(shadowrules, args.shadow_report)
+    if args.profile:
+        PROFILER = RuleProfiler()
+        PROFILE_FILE = args.profile
+
+    # A multireddit of all of them, so each listing is a single request
+    sub = reddit.get_subreddit('+'.join(args.subreddit))
     read_thinglists()
-    comments_ph = None
-    submissions_ph = None
-
-    while True:
-        logging.debug("Loop start")
-        loopstart = time.time()
+    AUTHOR_CACHE.configure(args.author_ttl, args.author_cache_size,
+                           args.author_cache_file)
+    AUTHOR_CACHE.load()
+    bucket = None
+    if args.adaptive:
+        bucket = TokenBucket(args.poll_budget / 60.0, 5)
+    streams = STREAMS = [
+        Stream('modqueue', sub.get_mod_queue, is_modqueue=True,
+               bucket=bucket),
+        Stream('comments', sub.get_comments, limit=500,
+               checkpoint=CHECKPOINT, bucket=bucket),
+        Stream('submissions', sub.get_new, checkpoint=CHECKPOINT,
+               bucket=bucket),
+    ]
+
+    recorder = None
+    if args.record:
+        recorder = Recorder(args.record)
+        AUTHOR_CACHE.on_fetch = recorder.author
+
+    def check(stream, things):
+        if recorder is not None:
+            recorder.things(stream.name, things)
+        checkstream(stream, things, rulehandlers)
+
+    policy = None
+    if args.adaptive:
+        policy = AdaptivePolicy(streams, budget=args.poll_budget)
+
+    def periodic():
+        housekeeping()
+        if RECHECKER is not None:
+            recheck(reddit, rulehandlers, bucket)
 
-        try:
-            modqueue_items = sub.get_mod_queue(limit=100)
-        except Exception, e:
-            modqueue_items = []
-
-        num = 0
-        for modqueue_item in modqueue_items:
-            num += 1
-            matchrules(modqueue_item, rh.rules, is_modqueue=True)
-        logging.info("Checked %d modqueue items" % num)
-
-        try:
-            if comments_ph == None:
-                comments = sub.get_comments(limit=100)
-            else:
-                comments = sub.get_comments(place_holder=comments_ph,
-                        limit=500)
-        except Exception, e:
-            comments = []
-
-        num = 0
-        for comment in comments:
-            logging.debug("Checking %s start" % comment.name)
-            num += 1
-            if comments_ph == None or num == 1:
-                comments_ph = comment.id
-            matchrules(comment, rh.rules)
-            logging.debug("Checking %s done" % comment.name)
-        logging.info("Checked %d comments" % num)
+    try:
+        if args.pipelined:
+            Pipeline(streams, check, policy=policy, bucket=bucket).run(
+                periodic)
+        else:
+            Scheduler(streams, check, policy=policy, bucket=bucket).run(
+                periodic)
+    finally:
+        logging.info("Waiting for %d actions to finish" % EXECUTOR.pending())
+        EXECUTOR.drain(60)
+        if DIGESTS is not None:
+            # Queue the digests the actions were collected into
+            DIGESTS.flush(everything=True)
+            EXECUTOR.drain(60)
+        if SHADOW is not None:
+            SHADOW.close(10)
+        if POOL is not None:
+            POOL.close()
+        CHECKPOINT.close()
+
+
+def read_rules(rulesdir, subreddits):
+    """Get a RuleHandler for each subreddit, keyed by lowercase name.
+    Subreddits using the same directory share the handler."""
+    rulehandlers = {}
+    bydirectory = {}
+    for subreddit in subreddits:
+        directory = rulesdir
+        if len(subreddits) > 1:
+            for name in (subreddit, subreddit.lower()):
+                if os.path.isdir(os.path.join(rulesdir, name)):
+                    directory = os.path.join(rulesdir, name)
+                    break
+        directory = os.path.realpath(directory)
+        if directory not in bydirectory:
+            bydirectory[directory] = RuleHandler(directory, '*.rule')
+        rulehandlers[subreddit.lower()] = bydirectory[directory]
+    return rulehandlers
+
+
+def checkstream(stream, things, rulehandlers):
+    """Check things from stream against the rules of their subreddit, oldest
+    first"""
+    global MODQUEUE_VERSIONS
+    if stream.is_modqueue:
+        versions = dict((subreddit, rulehandler.version)
+                        for subreddit, rulehandler in rulehandlers.iteritems())
+        if MODQUEUE_VERSIONS is not None and versions != MODQUEUE_VERSIONS:
+            logging.info("Rules changed, checking all of %s again" %
+                         stream.name)
+            stream.forget()
+        MODQUEUE_VERSIONS = versions
+    items = []
+    for thing in reversed(things):
+        subreddit = thing.subreddit.display_name.lower()
+        if subreddit not in rulehandlers:
+            logging.warning("No rules for %s in /r/%s" % (thing.name,
+                                                         subreddit))
+        elif not checked(thing, stream.is_modqueue):
+            items.append((rulehandlers[subreddit], thing))
+    results = [None] * len(items)
+    if POOL is not None and items:
+        results = POOL.match(items)
+    for (rulehandler, thing), result in zip(items, results):
+        logging.debug("Checking %s start" % thing.name)
+        ruleset = rulehandler.ruleset
+        matchrules(thing, ruleset, is_modqueue=stream.is_modqueue,
+                   result=result)
+        logging.debug("Checking %s done with rules version %d" % (
+            thing.name, ruleset.version))
+    stream.done(things)
+    logging.info("Checked %d things from %s" % (len(things), stream.name))
+
+
+def recheck(reddit, rulehandlers, bucket=None):
+    """Check things which are due again against the rules on fields which
+    change over time"""
+    things = [snapshot(thing) for thing in RECHECKER.fetch(reddit, bucket)]
+    items = []
+    for thing in things:
+        subreddit = thing.subreddit.display_name.lower()
+        removed = getattr(thing, 'banned_by', None)
+        if subreddit not in rulehandlers or removed:
+            RECHECKER.discard(thing.name)
+            continue
+        items.append((rulehandlers[subreddit], thing))
+    results = [None] * len(items)
+    if POOL is not None and items:
+        results = POOL.match(items, volatile=True)
+    for (rulehandler, thing), result in zip(items, results):
+        ruleset = rulehandler.ruleset.volatile()
+        if matchrules(thing, ruleset, recheck=True, result=result):
+            RECHECKER.discard(thing.name, matched=True)
+    if things:
+        logging.info("Rechecked %d things" % len(things))
+
+
+def housekeeping():
+    """Things to do every 30 seconds, between checking streams"""
+    CHECKPOINT.commit()
+
+    logging.info("Seen: %(size)d things in %(generations)d generations, "
+                 "%(early_rotations)d early rotations, estimated false "
+                 "positive rate %(false_positive_rate)g" % SEEN.stats())
+    logging.info("Actions: %(queued)d queued, %(performed)d performed, "
+                 "%(retried)d retried, %(failed)d failed, %(duplicates)d "
+                 "duplicates" % EXECUTOR.stats)
+    logging.info("Author cache: %(size)d authors, %(hits)d hits, "
+                 "%(misses)d misses, %(evictions)d evictions" %
+                 AUTHOR_CACHE.stats())
+    if DIGESTS is not None:
+        DIGESTS.flush()
+        logging.info("Digests: %(messages)d messages in %(sent)d digests, "
+                     "%%d waiting" % DIGESTS.stats % DIGESTS.pending())
+    for stream in STREAMS:
+        if stream.is_modqueue:
+            logging.info("Stream %s: %d things, %d syncs in %d pages" % (
+                stream.name, len(stream.members), stream.syncs,
+                stream.paged))
+        elif stream.paged or stream.gaps:
+            logging.info("Stream %s: %d pages to catch up, %d gaps, about %d "
+                         "things skipped" % (stream.name, stream.paged,
+                                             stream.gaps, stream.skipped))
+    if POOL is not None:
+        logging.info("Workers: %(things)d checked, %(parent)d left to the "
+                     "main process, %(restarts)d starts, %(timeouts)d "
+                     "timeouts, %(kills)d rules stopped" % POOL.stats)
+    if SHADOW is not None:
+        logging.info("Shadow: %(checked)d checked, %(live)d matched live, "
+                     "%(shadow)d matched shadow, %(different)d different, "
+                     "%(unknown)d unknown, %(dropped)d dropped" %
+                     SHADOW.stats)
+    if RECHECKER is not None:
+        logging.info("Recheck: %(size)d things, %(requests)d requests, "
+                     "%(fetched)d fetched, %(matched)d matched, %(dropped)d "
+                     "dropped" % RECHECKER.stats())
+    try:
+        AUTHOR_CACHE.save()
+    except Exception, e:
+        logging.warning("Failed saving author cache: %s" % e)
 
+    if PROFILER is not None:
+        PROFILER.log(300)
         try:
-            if submissions_ph == None:
-                submissions = sub.get_new(limit=100)
-            else:
-                submissions = sub.get_new(place_holder=submissions_ph,
-                        limit=100)
+            PROFILER.write(PROFILE_FILE)
         except Exception, e:
-            submissions = []
-
-        num = 0
-        for submission in submissions:
-            num += 1
-            if submissions_ph == None or num == 1:
-                submissions_ph = submission.id
-            matchrules(submission, rh.rules)
-        logging.info("Checked %d submissions" % num)
-
-        loopend = time.time()
-        sleepfor = max(0.0, 30.0 - (loopend - loopstart))
-        logging.info("Loop end. Sleeping %f s" % sleepfor)
-        time.sleep(sleepfor)
+            logging.warning("Failed writing profile: %s" % e)
 
 
 if __name__ == "__main__":
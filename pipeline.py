@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from Queue import Queue, Empty
+import logging
+import threading
+import time
+
+
+class StreamStats(object):
+    """Timings of the stages a stream's things go through in the pipeline"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.items = 0
+        self.fetch_time = 0.0
+        self.wait_time = 0.0
+        self.check_time = 0.0
+        self.max_depth = 0
+
+    def add(self, items, fetch_time, wait_time, check_time, depth):
+        self.batches += 1
+        self.items += items
+        self.fetch_time += fetch_time
+        self.wait_time += wait_time
+        self.check_time += check_time
+        self.max_depth = max(self.max_depth, depth)
+
+    def summary(self):
+        batches = max(1, self.batches)
+        return ("%d batches, %d items, fetch %.2f s, queued %.2f s, "
+                "check %.2f s on average, queue depth up to %d" % (
+                    self.batches, self.items, self.fetch_time / batches,
+                    self.wait_time / batches, self.check_time / batches,
+                    self.max_depth))
+
+
+class Pipeline(object):
+    """
+    Fetches streams concurrently and checks the things in them as they
+    arrive.
+
+    Every stream has a fetcher thread, which polls it according to its
+    interval and puts the things on a bounded queue. The thread calling run()
+    takes them off the queue and passes them to check(stream, things), so
+    the network latency of one stream overlaps with checking another, and a
+    slow stream doesn't delay the others. When the queue is full the fetchers
+    wait. Like for the Scheduler, a policy may adjust the streams and a token
+    bucket limit the fetches. Stats are logged every interval seconds.
+    """
+
+    def __init__(self, streams, check, interval=30.0, maxsize=10,
+                 policy=None, bucket=None):
+        self.streams = streams
+        self.check = check
+        self.interval = interval
+        self.policy = policy
+        self.bucket = bucket
+        self.queue = Queue(maxsize)
+        self.stats = dict((stream.name, StreamStats()) for stream in streams)
+
+    def _fetch(self, stream):
+        while True:
+            start = time.time()
+            if self.bucket is not None:
+                pages = (self.policy.pages(stream, False) if self.policy
+                         else 1)
+                self.bucket.acquire(pages)
+            things = stream.fetch()
+            fetched = time.time()
+            if self.policy is not None:
+                self.policy.update(stream)
+            self.queue.put((stream, things, fetched - start, fetched))
+            time.sleep(max(0.0, stream.interval - (time.time() - start)))
+
+    def start(self):
+        for stream in self.streams:
+            thread = threading.Thread(target=self._fetch, args=(stream,),
+                                      name="fetch-%s" % stream.name)
+            thread.daemon = True
+            thread.start()
+
+    def run(self, periodic=None):
+        """Check things from the streams forever, calling periodic() and
+        logging the pipeline stats every interval seconds"""
+        self.start()
+        reported = time.time()
+        while True:
+            timeout = max(0.0, reported + self.interval - time.time())
+            try:
+                stream, things, fetch_time, fetched = self.queue.get(
+                    timeout=timeout)
+            except Empty:
+                pass
+            else:
+                depth = self.queue.qsize()
+                start = time.time()
+                self.check(stream, things)
+                self.stats[stream.name].add(len(things), fetch_time,
+                                            start - fetched,
+                                            time.time() - start, depth)
+            if time.time() - reported >= self.interval:
+                reported = time.time()
+                self.report()
+                if periodic is not None:
+                    periodic()
+
+    def report(self):
+        for name, stats in sorted(self.stats.iteritems()):
+            logging.info("Pipeline %s: %s" % (name, stats.summary()))
+            stats.reset()
+        if self.policy is not None:
+            logging.info("Polling %s" % self.policy.summary())
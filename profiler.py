@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from authors import AUTHOR_CACHE
+from os import path
+import logging
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+           0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, float('inf'))
+
+
+class Timings(object):
+    """Counts and a histogram of the time spent evaluating something"""
+    __slots__ = ('evaluations', 'matches', 'fetches', 'seconds', 'buckets')
+
+    def __init__(self):
+        self.evaluations = 0
+        self.matches = 0
+        self.fetches = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds, matched, fetches=0):
+        self.evaluations += 1
+        self.matches += int(matched)
+        self.fetches += fetches
+        self.seconds += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, p):
+        """Get the upper bound of the bucket containing the p'th
+        percentile"""
+        wanted = self.evaluations * p / 100.0
+        count = 0
+        for i, bound in enumerate(BUCKETS):
+            count += self.buckets[i]
+            if count >= wanted:
+                return bound
+        return BUCKETS[-1]
+
+
+def _label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+class RuleProfiler(object):
+    """
+    Records, for each rule and each of its conditions, how often it was
+    evaluated and matched, the time it took and how many authors had to be
+    fetched from reddit for it. Rules are identified by their filename, so
+    the numbers survive reloading the rules.
+    """
+
+    def __init__(self):
+        self.index = Timings()
+        self.logged = 0
+        self._rules = {}
+        self._conditions = {}
+        self._lock = threading.Lock()
+
+    def candidates(self, find, values, scans):
+        start = time.time()
+        candidates = find(values, scans)
+        self.index.add(time.time() - start, bool(candidates))
+        return candidates
+
+    def rule(self, rule, values, scans):
+        start = time.time()
+        matches = rule.match(values, scans, self)
+        elapsed = time.time() - start
+        name = path.basename(rule['_filename'])
+        with self._lock:
+            if name not in self._rules:
+                self._rules[name] = Timings()
+            self._rules[name].add(elapsed, matches is not None)
+        return matches
+
+    def condition(self, rule, condition, values, scans):
+        misses = AUTHOR_CACHE.misses
+        start = time.time()
+        result = condition.match(values, scans)
+        elapsed = time.time() - start
+        key = (path.basename(rule['_filename']), condition.key)
+        with self._lock:
+            if key not in self._conditions:
+                self._conditions[key] = Timings()
+            self._conditions[key].add(elapsed, result is not False,
+                                      AUTHOR_CACHE.misses - misses)
+        return result
+
+    def summary(self, top=5):
+        """Get log lines about the most expensive rules and conditions"""
+        with self._lock:
+            rules = sorted(self._rules.iteritems(),
+                           key=lambda item: -item[1].seconds)[:top]
+            conditions = sorted(self._conditions.iteritems(),
+                                key=lambda item: -item[1].percentile(99))[:top]
+        lines = ["Rule index: %d things, %.3f s" % (self.index.evaluations,
+                                                     self.index.seconds)]
+        for name, timings in rules:
+            lines.append("Rule %s: %d evaluations, %d matches, %.3f s" % (
+                name, timings.evaluations, timings.matches, timings.seconds))
+        for (name, key), timings in conditions:
+            lines.append("Condition %s %s: %d evaluations, %d matches, "
+                         "%.3f s, p99 <= %g s, %d api fetches" % (
+                             name, key, timings.evaluations, timings.matches,
+                             timings.seconds, timings.percentile(99),
+                             timings.fetches))
+        return lines
+
+    def log(self, interval=0):
+        """Log the summary, unless it was logged less than interval seconds
+        ago"""
+        if time.time() - self.logged < interval:
+            return
+        self.logged = time.time()
+        for line in self.summary():
+            logging.info(line)
+
+    def prometheus(self):
+        """Get the numbers in the Prometheus text format"""
+        lines = []
+        with self._lock:
+            rules = sorted(self._rules.iteritems())
+            conditions = sorted(self._conditions.iteritems())
+        for metric, kind, description, attribute in (
+                ('rule_evaluations_total', 'counter',
+                 "Times the rule was evaluated", 'evaluations'),
+                ('rule_matches_total', 'counter',
+                 "Times the rule matched", 'matches'),
+                ('rule_seconds_total', 'counter',
+                 "Time spent evaluating the rule", 'seconds')):
+            lines.append("# HELP modbot_%s %s" % (metric, description))
+            lines.append("# TYPE modbot_%s %s" % (metric, kind))
+            for name, timings in rules:
+                lines.append('modbot_%s{rule="%s"} %s' % (
+                    metric, _label(name), getattr(timings, attribute)))
+        for metric, description, attribute in (
+                ('condition_matches_total',
+                 "Times the condition was fulfilled", 'matches'),
+                ('condition_api_fetches_total',
+                 "Authors fetched from reddit for the condition", 'fetches')):
+            lines.append("# HELP modbot_%s %s" % (metric, description))
+            lines.append("# TYPE modbot_%s counter" % metric)
+            for (name, key), timings in conditions:
+                lines.append('modbot_%s{rule="%s",condition="%s"} %s' % (
+                    metric, _label(name), _label(key),
+                    getattr(timings, attribute)))
+        lines.append("# HELP modbot_condition_seconds Time spent evaluating "
+                     "the condition")
+        lines.append("# TYPE modbot_condition_seconds histogram")
+        for (name, key), timings in conditions:
+            labels = 'rule="%s",condition="%s"' % (_label(name), _label(key))
+            count = 0
+            for bound, bucket in zip(BUCKETS, timings.buckets):
+                count += bucket
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('modbot_condition_seconds_bucket{%s,le="%s"} %d'
+                             % (labels, le, count))
+            lines.append('modbot_condition_seconds_sum{%s} %r' % (
+                labels, timings.seconds))
+            lines.append('modbot_condition_seconds_count{%s} %d' % (
+                labels, timings.evaluations))
+        return u"\n".join(lines) + u"\n"
+
+    def write(self, filename):
+        """Write the numbers to filename in the Prometheus text format"""
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(self.prometheus().encode('utf-8'))
+        os.rename(tmpname, filename)
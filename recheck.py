@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+# The most things reddit returns by id in one request
+BATCH = 100
+
+
+class Rechecker(object):
+    """
+    Things which didn't match any rule, but might later match one with a
+    condition on a field which changes over time, like the score or the
+    number of reports.
+
+    Every interval seconds, until window seconds after they were added, the
+    things are fetched again from reddit, up to 100 in a single request, to
+    be checked again. At most capacity things are kept, forgetting the oldest
+    first.
+    """
+
+    def __init__(self, window=3600, interval=600, capacity=100000):
+        self.window = window
+        self.interval = interval
+        self.capacity = capacity
+        self.requests = 0
+        self.fetched = 0
+        self.matched = 0
+        self.dropped = 0
+        # fullname -> (time added, time due), ordered by time due
+        self._things = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._things)
+
+    def add(self, thing):
+        now = time.time()
+        with self._lock:
+            if thing.name in self._things:
+                return
+            while len(self._things) >= self.capacity:
+                self._things.popitem(last=False)
+                self.dropped += 1
+            self._things[thing.name] = (now, now + self.interval)
+
+    def discard(self, fullname, matched=False):
+        """Stop rechecking fullname, because it matched a rule or was
+        removed"""
+        with self._lock:
+            self._things.pop(fullname, None)
+            self.matched += int(matched)
+
+    def due(self):
+        """Get the fullnames of the things which are due to be checked again,
+        and schedule their next check (or forget them if their window has
+        passed)"""
+        now = time.time()
+        fullnames = []
+        with self._lock:
+            while self._things:
+                fullname, (added, due) = next(self._things.iteritems())
+                if due > now:
+                    break
+                del self._things[fullname]
+                fullnames.append(fullname)
+                if due + self.interval <= added + self.window:
+                    self._things[fullname] = (added, due + self.interval)
+        return fullnames
+
+    def fetch(self, reddit, bucket=None):
+        """Get the things which are due to be checked again, fresh from
+        reddit. If a TokenBucket is given, each request takes a token."""
+        fullnames = self.due()
+        things = []
+        for i in xrange(0, len(fullnames), BATCH):
+            batch = fullnames[i:i + BATCH]
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                things.extend(reddit.get_info(thing_id=batch))
+            except Exception, e:
+                logging.warning("Failed fetching %d things to recheck: %s" %
+                                (len(batch), e))
+            self.requests += 1
+        self.fetched += len(things)
+        return things
+
+    def stats(self):
+        return {'size': len(self._things), 'requests': self.requests,
+                'fetched': self.fetched, 'matched': self.matched,
+                'dropped': self.dropped}
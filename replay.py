@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from authors import AUTHOR_CACHE, ProfileUnavailable
+from corpus import read_corpus, generate, SPAMWORDS
+from profiler import RuleProfiler
+from workers import WorkerPool
+import argparse
+import logging
+import modbot
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+
+def percentile(values, p):
+    """Get the p'th percentile of a sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def replay(things, rulehandlers, repeat=1, workers=0, batch=500):
+    """Check things against the rules, as the bot would but without
+    performing any actions. Returns the list of would-be actions as
+    (fullname, action, rule filename) and the time taken per thing.
+
+    With workers, things are checked by a WorkerPool of that many
+    processes, batch things at a time, and the time per thing is the
+    average over its batch."""
+    actions = []
+
+    def performaction(thing, action, rule, matches):
+        actions.append((thing.name, action.strip(), rule['_filename']))
+
+    origperform = modbot.performaction
+    modbot.performaction = performaction
+    pool = None
+    if workers > 0:
+        pool = WorkerPool(rulehandlers, workers)
+    timings = []
+    try:
+        for i in xrange(repeat):
+            modbot.SEEN = modbot.SeenStore()
+            modbot.MODQUEUE_ACTED = modbot.SeenStore()
+            AUTHOR_CACHE.unavailable = 0
+            del actions[:]
+            items = []
+            for stream, thing in things:
+                subreddit = thing.subreddit.display_name.lower()
+                rh = rulehandlers.get(subreddit)
+                if rh is None:
+                    continue
+                if pool is None:
+                    start = time.time()
+                    _matchrules(thing, rh.ruleset, stream == 'modqueue')
+                    timings.append(time.time() - start)
+                    continue
+                items.append((rh, thing, stream == 'modqueue'))
+                if len(items) == batch:
+                    timings.extend(_replay_batch(pool, items))
+                    items = []
+            if items:
+                timings.extend(_replay_batch(pool, items))
+    finally:
+        modbot.performaction = origperform
+        if pool is not None:
+            pool.close()
+    return actions, timings
+
+
+def _matchrules(thing, ruleset, is_modqueue, result=None):
+    """Check thing like the bot would. Things whose rules need an author
+    which isn't in the corpus can't be checked, and are counted by
+    AUTHOR_CACHE.unavailable instead."""
+    try:
+        modbot.matchrules(thing, ruleset, is_modqueue=is_modqueue,
+                          result=result)
+    except ProfileUnavailable:
+        pass
+
+
+def _replay_batch(pool, items):
+    start = time.time()
+    results = pool.match([(rh, thing) for rh, thing, is_modqueue in items])
+    for (rh, thing, is_modqueue), result in zip(items, results):
+        _matchrules(thing, rh.ruleset, is_modqueue, result)
+    elapsed = time.time() - start
+    return [elapsed / len(items)] * len(items)
+
+
+def report(things, actions, timings):
+    timings = sorted(timings)
+    total = sum(timings)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print "%d things checked in %.3f s: %.0f things/s" % (
+        len(timings), total, len(timings) / total if total else 0)
+    print "Per thing: p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, max %.3f ms" % (
+        percentile(timings, 50) * 1000, percentile(timings, 90) * 1000,
+        percentile(timings, 99) * 1000, percentile(timings, 100) * 1000)
+    print "Max RSS: %d kB" % maxrss
+    print "%d actions would have been performed" % len(actions)
+    if AUTHOR_CACHE.unavailable:
+        print ("%d things weren't checked, because their authors aren't in "
+               "the corpus" % AUTHOR_CACHE.unavailable)
+
+
+def load(corpusfile, rulesdir):
+    things, authors = read_corpus(corpusfile)
+    AUTHOR_CACHE.configure(10 ** 10, max(len(authors), 1))
+    for profile in authors:
+        AUTHOR_CACHE.put(profile)
+    subreddits = sorted(set(thing.subreddit.display_name
+                            for stream, thing in things))
+    return things, modbot.read_rules(rulesdir, subreddits)
+
+
+def write_rules(directory, count, seed=0):
+    """Write count synthetic rules into directory, mostly word lists like
+    real banned phrase rules, some on domains, titles, users and numbers.
+    Every seventh rule includes one of the spam words of the synthetic
+    corpus, so some of them match."""
+    rng = random.Random(seed)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    for i in xrange(count):
+        words = [''.join(rng.choice(letters)
+                         for j in xrange(rng.randint(5, 10)))
+                 for k in xrange(rng.randint(3, 40))]
+        if i % 7 == 0:
+            words.append(SPAMWORDS[i % len(SPAMWORDS)])
+        kind = i % 10
+        if kind < 6:
+            header = "Body: (%s)\n" % '|'.join(words)
+        elif kind == 6:
+            header = "Type: submission\nDomain: (%s)\\.com\n" % '|'.join(words)
+        elif kind == 7:
+            header = "Type: submission\nTitle: \\b(%s)\\b\n" % '|'.join(words)
+        elif kind == 8:
+            header = "Body: %s\nUserage: < 10\n" % words[0]
+        else:
+            header = "Score: <= -10\nUsername: ^(%s)$\n" % '|'.join(words)
+        with open(os.path.join(directory, 'rule%04d.rule' % i), 'w') as f:
+            f.write(header + "Actions: log\n")
+
+
+def bench(args):
+    """Replay a synthetic corpus against synthetic rule sets of growing
+    size"""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        corpusfile = os.path.join(tmpdir, 'corpus.jsonl')
+        generate(corpusfile, comments=args.things,
+                 submissions=args.things / 10, seed=args.seed)
+        print "%8s %10s %10s %10s %10s" % ("rules", "things/s", "p50 ms",
+                                           "p99 ms", "actions")
+        for count in args.rules:
+            rulesdir = os.path.join(tmpdir, 'rules%d' % count)
+            os.mkdir(rulesdir)
+            write_rules(rulesdir, count, seed=args.seed)
+            things, rulehandlers = load(corpusfile, rulesdir)
+            actions, timings = replay(things, rulehandlers, args.repeat,
+                                      args.workers)
+            timings.sort()
+            print "%8d %10.0f %10.3f %10.3f %10d" % (
+                count, len(timings) / sum(timings),
+                percentile(timings, 50) * 1000,
+                percentile(timings, 99) * 1000, len(actions))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Replay recorded or synthetic listings through the "
+            "rules, without network access")
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('replay', help="replay a corpus against rules")
+    p.add_argument('corpus')
+    p.add_argument('rulesdir')
+    p.add_argument('--repeat', type=int, default=1)
+    p.add_argument('--actions', action='store_true', default=False,
+                   help="list the actions which would have been performed")
+    p.add_argument('--profile', action='store_true', default=False,
+                   help="show the most expensive rules and conditions")
+    p.add_argument('--workers', type=int, default=0,
+                   help="check things in this many processes")
+
+    p = subparsers.add_parser('generate', help="write a synthetic corpus")
+    p.add_argument('corpus')
+    p.add_argument('--comments', type=int, default=10000)
+    p.add_argument('--submissions', type=int, default=1000)
+    p.add_argument('--authors', type=int, default=2000)
+    p.add_argument('--subreddit', default='test')
+    p.add_argument('--seed', type=int, default=0)
+
+    p = subparsers.add_parser('bench', help="benchmark synthetic rule sets")
+    p.add_argument('--rules', type=int, nargs='+', default=[10, 100, 300])
+    p.add_argument('--workers', type=int, default=0,
+                   help="check things in this many processes")
+    p.add_argument('--things', type=int, default=5000)
+    p.add_argument('--repeat', type=int, default=1)
+    p.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING,
+            format="[%(asctime)s] %(levelname)-7s %(message)s")
+
+    if args.command == 'generate':
+        generate(args.corpus, args.comments, args.submissions, args.authors,
+                 args.subreddit, args.seed)
+    elif args.command == 'replay':
+        things, rulehandlers = load(args.corpus, args.rulesdir)
+        if args.profile:
+            modbot.PROFILER = RuleProfiler()
+            if args.workers > 0:
+                logging.warning("Rules are only timed in the main process, "
+                                "ignoring --workers for --profile")
+                args.workers = 0
+        actions, timings = replay(things, rulehandlers, args.repeat,
+                                  args.workers)
+        if args.actions:
+            for action in actions:
+                print "%s %s %s" % action
+        report(things, actions, timings)
+        if args.profile:
+            for line in modbot.PROFILER.summary(10):
+                print line
+    elif args.command == 'bench':
+        bench(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -33,9 +33,606 @@ from glob import glob
 from os import path
 import codecs
 import logging
+import operator
+import re
+import threading
+import time
+from scanner import KeywordScanner, FieldScans, required_literals
+from scanner import backtracking_hazard
+from templates import Template
+from values import ValueGetter, ItemValues, NETWORK_FIELDS, NUMERIC_FIELDS
+from values import FIELD_TYPES, THING_TYPES, VOLATILE_FIELDS, VERDICT_FIELDS
+from verdicts import AuthorVerdicts
 from watchdog.events import PatternMatchingEventHandler, LoggingEventHandler
 from watchdog.observers import Observer
 
+try:
+    # Matches in linear time, but doesn't support everything re does
+    import re2
+except ImportError:
+    re2 = None
+
+
+# Conditions are evaluated in this order, so simple lookups are done before
+# ones which require additional hits to the reddit api, until they are
+# reordered by how quickly they reject things
+FIELD_ORDER = ['type', 'body', 'bodylength', 'dayhour', 'domain', 'downvotes',
+               'numreports', 'score', 'title', 'upvotes', 'url', 'username',
+               'authorflags', 'userkarma', 'userage']
+
+# Guesses of the time conditions take, until they've been measured. Fetching
+# the author from reddit takes far longer than anything else.
+NUMERIC_COST = 0.000001
+REGEX_COST = 0.00001
+NETWORK_COST = 0.05
+
+# The conditions of the rules are reordered after checking this many things
+REORDER_INTERVAL = 1000
+
+# Seconds to wait for more changes to the rules files before reloading them
+RELOAD_DELAY = 2.0
+
+# Seconds a single regex search may take before its rule is quarantined
+REGEX_BUDGET = 0.05
+
+# If set, called with every rule before a thing is matched against it, see
+# workers.py
+TRACE = None
+
+_OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt,
+              '>=': operator.ge, '==': operator.eq}
+_PREDICATE = r'(?:(<=|>=|==|<|>)\s*(-?\d+)|in\s+(-?\d+)\s*\.\.\s*(-?\d+))'
+_PREDICATES = re.compile(r'^(?:\s*%s)+\s*$' % _PREDICATE)
+
+
+def numeric_predicates(value):
+    """Parse the value of a condition on a numeric field, like "< 100",
+    ">= 10 < 20" (all must hold) or "in 10..20" (inclusive), into a list of
+    (operator, number). Without "in", "10..20" is still a regex.
+
+    Returns None if value is a regex instead. Raises ValueError if it looks
+    like a comparison, but isn't a valid one."""
+    if _PREDICATES.match(value) is None:
+        if value.lstrip()[:1] in ('<', '>', '='):
+            raise ValueError("Invalid numeric condition %s" % value)
+        return None
+    predicates = []
+    for op, number, low, high in re.findall(_PREDICATE, value):
+        if op:
+            predicates.append((_OPERATORS[op], int(number)))
+        else:
+            predicates.append((operator.ge, int(low)))
+            predicates.append((operator.le, int(high)))
+    return predicates
+
+
+class BudgetExceeded(Exception):
+    """Raised when a regex search takes longer than REGEX_BUDGET"""
+
+    def __init__(self, condition, seconds):
+        super(BudgetExceeded, self).__init__(
+            "%s took %.3f seconds" % (condition.key, seconds))
+        self.condition = condition
+        self.seconds = seconds
+
+
+class ConditionStats(object):
+    """
+    How often a condition passed recently, and how long it took. Every
+    SAMPLE'th evaluation is timed. The numbers are halved every time the
+    conditions are reordered, so they follow changes in the things checked.
+    """
+    __slots__ = ('evaluations', 'passes', 'timed', 'seconds', 'count')
+    SAMPLE = 16
+    MIN_EVALUATIONS = 50
+    MIN_TIMED = 10
+
+    def __init__(self):
+        self.evaluations = 0.0
+        self.passes = 0.0
+        self.timed = 0.0
+        self.seconds = 0.0
+        self.count = 0
+
+    def rejection_cost(self, cost):
+        """Get the expected time spent on the condition per thing it rejects,
+        using the guessed cost until enough evaluations have been timed"""
+        if self.timed >= self.MIN_TIMED:
+            cost = self.seconds / self.timed
+        passrate = 0.5
+        if self.evaluations >= self.MIN_EVALUATIONS:
+            passrate = self.passes / self.evaluations
+        return cost / max(1.0 - passrate, 0.001)
+
+    def decay(self):
+        self.evaluations /= 2
+        self.passes /= 2
+        self.timed /= 2
+        self.seconds /= 2
+
+
+class Condition(object):
+    """A single "Field: regex" header line of a rule, compiled.
+
+    The key is kept as written (lowercased), so it can be used to look up
+    matches in templates.
+
+    If the regex looks like it can take exponential time (see hazard), it's
+    matched with re2 instead, if that's installed and supports it. Otherwise
+    the rule is quarantined when it's compiled."""
+
+    def __init__(self, key, value):
+        self.key = key
+        # Allow to make negative matches by prefixing with "!"
+        self.invert = key[0] == "!"
+        self.field = key[1:] if self.invert else key
+        self.regex = re.compile(u'(?P<full>%s)' % value, flags=re.IGNORECASE)
+        self.literals = required_literals(self.regex)
+        self.hazard = backtracking_hazard(self.regex)
+        self.search = self.regex.search
+        self.linear = False
+        if self.hazard is not None and re2 is not None:
+            try:
+                self.search = re2.compile(self.regex.pattern,
+                                          re.IGNORECASE).search
+                self.linear = True
+            except Exception:
+                pass
+        self.stats = ConditionStats()
+
+    @property
+    def order(self):
+        if self.field in FIELD_ORDER:
+            return FIELD_ORDER.index(self.field)
+        return -1
+
+    @property
+    def cost(self):
+        """Guess of the time it takes to evaluate the condition"""
+        if self.field in NETWORK_FIELDS:
+            return NETWORK_COST
+        return REGEX_COST
+
+    def match(self, values, scans=None):
+        """Match a thing, given its ItemValues, against the condition.
+
+        Returns False if the condition isn't fulfilled. Otherwise returns the
+        groups of the match, or True if there are none (when inverted, or
+        when the condition can't be evaluated for the thing and is ignored)"""
+        try:
+            fieldvalue = values.text(self.field)
+        except AttributeError:
+            # Ignore conditions we can't evaluate (eg. deleted authors)
+            return True
+        except TypeError:
+            return False
+
+        logging.debug("Match %s %s %s", values.thing.name, self.key,
+                      fieldvalue)
+        if scans is None or scans.possible(self, fieldvalue):
+            return self.match_text(fieldvalue)
+        return self.match_text(None)
+
+    def match_text(self, fieldvalue):
+        """Match the text of a field against the condition, like match(). A
+        fieldvalue of None is known not to match the regex.
+
+        Raises BudgetExceeded if the search took longer than REGEX_BUDGET.
+        That's only noticed once the search is done, a search which doesn't
+        end is stopped by the WorkerPool."""
+        m = None
+        if fieldvalue is not None:
+            start = time.time()
+            m = self.search(fieldvalue)
+            seconds = time.time() - start
+            if seconds > REGEX_BUDGET:
+                raise BudgetExceeded(self, seconds)
+        if (m is None) != self.invert:
+            return False
+        elif m:
+            return m.groupdict()
+        return True
+
+    @staticmethod
+    def create(key, value):
+        """Get the condition for a header line, numeric if the field is
+        numeric and the value a comparison"""
+        field = key[1:] if key[:1] == "!" else key
+        if field in NUMERIC_FIELDS:
+            predicates = numeric_predicates(value)
+            if predicates is not None:
+                return NumericCondition(key, predicates)
+        return Condition(key, value)
+
+    @staticmethod
+    def is_condition(key):
+        """Whether the header line key is a condition we understand"""
+        field = key[1:] if key[:1] == "!" else key
+        return not field.startswith('_') and (hasattr(ValueGetter, field) or
+                                              field in VERDICT_FIELDS)
+
+
+class NumericCondition(Condition):
+    """A condition comparing a numeric field to numbers, like "Score: < 0".
+
+    Matches have the value of the field as 'full'."""
+
+    def __init__(self, key, predicates):
+        self.key = key
+        self.invert = key[0] == "!"
+        self.field = key[1:] if self.invert else key
+        self.predicates = predicates
+        self.regex = None
+        self.literals = None
+        self.hazard = None
+        self.linear = False
+        self.stats = ConditionStats()
+
+    @property
+    def order(self):
+        # Comparing numbers is cheaper than any regex, unless the number
+        # has to be fetched from reddit
+        if self.field in NETWORK_FIELDS:
+            return FIELD_ORDER.index(self.field)
+        return FIELD_ORDER.index(self.field) - len(FIELD_ORDER)
+
+    @property
+    def cost(self):
+        if self.field in NETWORK_FIELDS:
+            return NETWORK_COST
+        return NUMERIC_COST
+
+    def match(self, values, scans=None):
+        try:
+            fieldvalue = values.value(self.field)
+        except AttributeError:
+            return True
+        except TypeError:
+            return False
+        if fieldvalue is None:
+            # Not available either, like reports the bot can't see, and
+            # None would compare less than any number
+            return True
+
+        logging.debug("Match %s %s %s", values.thing.name, self.key,
+                      fieldvalue)
+        for op, number in self.predicates:
+            if not op(fieldvalue, number):
+                return self.invert
+        if self.invert:
+            return False
+        return {u'full': unicode(fieldvalue)}
+
+
+class Rule(dict):
+    """A rule read from a rules file.
+
+    Behaves like a dict of the header lines (with lowercased keys) and the body
+    as 'content'. After compile() it also holds the conditions, in the order
+    they are evaluated, and the list of actions.
+
+    Type conditions are resolved by compile() into types, the names of the
+    types of things the rule can match (None if any), which also takes into
+    account which types have the fields of the other conditions.
+
+    A rule with "Scope: author" is matched against the authors of things
+    instead, by AuthorVerdicts, and gives them its flags rather than acting.
+
+    A rule with a regex which may take exponential time, or which took longer
+    than REGEX_BUDGET, is quarantined: it never matches, until the file is
+    changed and read again. quarantined tells why."""
+
+    def __init__(self, *args, **kwargs):
+        super(Rule, self).__init__(*args, **kwargs)
+        self.conditions = []
+        self.actions = []
+        self.types = None
+        self.type_matches = {}
+        self.templates = {}
+        self.scope = u'item'
+        self.flags = frozenset()
+        self.quarantined = None
+
+    @property
+    def volatile(self):
+        """Whether the rule has conditions on fields which change over time,
+        so a thing which didn't match it might later"""
+        return any(c.field in VOLATILE_FIELDS for c in self.conditions)
+
+    def compile(self):
+        conditions = [Condition.create(key, value)
+                      for key, value in self.iteritems()
+                      if Condition.is_condition(key)]
+        conditions.sort(key=lambda c: c.order)
+        types = None
+        type_matches = {}
+        for condition in conditions:
+            if condition.field == 'type':
+                possible = set()
+                for kind in THING_TYPES:
+                    result = condition.match_text(unicode(kind))
+                    if result is not False:
+                        possible.add(kind)
+                        if result is not True:
+                            type_matches.setdefault(kind, {})[
+                                condition.key] = result
+            elif FIELD_TYPES[condition.field] is not None:
+                # Things without the field never match, even if inverted
+                possible = set(FIELD_TYPES[condition.field])
+            else:
+                continue
+            types = possible if types is None else types & possible
+        actions = []
+        for key in ('action', 'actions'):
+            if key in self:
+                actions.extend(self[key].split(','))
+        scope = self.get('scope', u'item').lower()
+        if scope not in (u'item', u'author'):
+            raise ValueError("Unknown scope %s" % self['scope'])
+        flags = frozenset()
+        if scope == u'author':
+            types = set(['redditor']) if types is None else (
+                types & set(['redditor']))
+            if not types:
+                logging.warning("%s can't match any author" %
+                                path.relpath(self['_filename']))
+            if actions:
+                logging.warning("Actions of author rule %s are ignored" %
+                                path.relpath(self['_filename']))
+            default = path.splitext(path.basename(self['_filename']))[0]
+            flags = frozenset(flag.lower() for flag in re.split(
+                r'[\s,]+', self.get('flags', default)) if flag)
+        self.conditions = [c for c in conditions if c.field != 'type']
+        self.actions = actions
+        self.types = frozenset(types) if types is not None else None
+        self.scope = scope
+        self.flags = flags
+        for condition in self.conditions:
+            if condition.hazard is not None and not condition.linear:
+                self.quarantine("%s is unsafe: %s" % (condition.key,
+                                                      condition.hazard))
+                break
+        self.type_matches = type_matches
+        templates = {}
+        for key in ('subject', 'content'):
+            if key in self:
+                try:
+                    templates[key] = Template(self[key])
+                except ValueError, e:
+                    logging.warning("Invalid %s in %s: %s" % (
+                        key, path.relpath(self['_filename']), e))
+        self.templates = templates
+
+    def format(self, key, **kwargs):
+        """Format the header line or content key of the rule, using it as a
+        template"""
+        template = self.templates.get(key)
+        if template is None:
+            template = Template(self[key])
+        return template.format(**kwargs)
+
+    def quarantine(self, reason):
+        """Stop the rule from matching anything, because of reason"""
+        self.quarantined = reason
+        logging.error("Quarantined %s: %s" % (path.relpath(self['_filename']),
+                                              reason))
+
+    def reorder(self):
+        """Order the conditions by the expected time spent per thing they
+        reject, according to their recent stats, so things which don't
+        match are rejected as quickly as possible. A rule matches if all its
+        conditions do, so this doesn't change whether it matches."""
+        self.conditions = sorted(
+            self.conditions,
+            key=lambda c: (c.stats.rejection_cost(c.cost), c.order))
+        for condition in self.conditions:
+            condition.stats.decay()
+
+    def gate(self):
+        """Get the most selective condition which the scanner for its field
+        can rule out without hitting the api, or None"""
+        # Type has only two possible values, so it doesn't rule much out
+        gates = [c for c in self.conditions if c.literals is not None and
+                 not c.invert and c.field not in NETWORK_FIELDS and
+                 c.field != 'type']
+        if not gates:
+            return None
+        return max(gates, key=lambda c: min(len(l) for l in c.literals))
+
+    def match(self, values, scans=None, profiler=None):
+        """Match a thing, given its ItemValues, against the conditions of the
+        rule.
+
+        Returns a dict of matches (keyed by condition) if all conditions are
+        fulfilled, otherwise None. If the FieldScans for the thing are given,
+        regexes which can't match according to them are skipped. If a
+        RuleProfiler is given, every condition is timed by it."""
+        if self.types is not None and values.kind not in self.types:
+            return None
+        if self.quarantined is not None:
+            return None
+        if TRACE is not None:
+            TRACE(self)
+        matches = {}
+        for condition in self.conditions:
+            stats = condition.stats
+            stats.count += 1
+            timed = stats.count % stats.SAMPLE == 0
+            if timed:
+                start = time.time()
+            try:
+                if profiler is None:
+                    result = condition.match(values, scans)
+                else:
+                    result = profiler.condition(self, condition, values,
+                                                scans)
+            except BudgetExceeded, e:
+                self.quarantine("%s on %s" % (e, values.thing.name))
+                return None
+            stats.evaluations += 1
+            if timed:
+                stats.timed += 1
+                stats.seconds += time.time() - start
+            if result is False:
+                return None
+            stats.passes += 1
+            if result is not True:
+                matches[condition.key] = result
+        matches.update(self.type_matches.get(values.kind, ()))
+        return matches
+
+
+class RuleSet(object):
+    """An ordered list of compiled rules, with the conditions of all the rules
+    grouped by field into one scanner per field.
+
+    The rules are divided by the types of things they can match, so a thing
+    is only tried against the rules for its type. Each rule which has a
+    condition that can be checked by a scanner is indexed by it, so only the
+    rules whose conditions were found by scanning the fields of a thing are
+    tried, still in order of filename.
+
+    Author rules are kept apart, in author_rules, and matched against authors
+    by the AuthorVerdicts in verdicts, which is kept for as long as the author
+    rules don't change.
+
+    A RuleSet isn't changed once created (except for the order of the
+    conditions of its rules). When the rules change, a new one is built with
+    the next version number, reusing the scanners of the previous one for
+    fields whose conditions didn't change."""
+
+    def __init__(self, rules, previous=None, version=0):
+        self.version = version
+        rules = sorted(rules, key=lambda rule: rule['_filename'])
+        self.rules = tuple(rule for rule in rules if rule.scope != u'author')
+        self.author_rules = tuple(rule for rule in rules
+                                  if rule.scope == u'author')
+        if (previous is not None and map(id, previous.author_rules) ==
+                map(id, self.author_rules)):
+            self.verdicts = previous.verdicts
+        else:
+            self.verdicts = AuthorVerdicts(self.author_rules)
+        conditions = {}
+        # For each type, the gated rules by field and condition, and the
+        # ungated ones. Things of other types are only tried against the
+        # rules for any type.
+        self._types = dict((kind, ({}, [])) for kind in THING_TYPES)
+        self._other = ({}, [])
+        for index, rule in enumerate(self.rules):
+            for condition in rule.conditions:
+                if condition.literals is not None:
+                    conditions.setdefault(condition.field, []).append(
+                        condition)
+            if rule.types is None:
+                buckets = self._types.values() + [self._other]
+            else:
+                buckets = [self._types[kind] for kind in rule.types]
+            gate = rule.gate()
+            for gated, ungated in buckets:
+                if gate is None:
+                    ungated.append(index)
+                else:
+                    gated.setdefault(gate.field, {}).setdefault(
+                        gate, []).append(index)
+        self._scanners = {}
+        for field, field_conditions in conditions.iteritems():
+            scanner = None
+            if previous is not None:
+                scanner = previous._scanners.get(field)
+            if (scanner is None or
+                    scanner.conditions != frozenset(field_conditions)):
+                scanner = KeywordScanner(field_conditions)
+            self._scanners[field] = scanner
+        self._checked = 0
+        self._volatile = None
+        # The types of things which may match volatile rules
+        self.volatile_kinds = frozenset(
+            kind for rule in self.rules if rule.volatile
+            for kind in (rule.types or THING_TYPES))
+
+    def volatile(self):
+        """Get a RuleSet of just the volatile rules, for checking things
+        again later"""
+        if self._volatile is None:
+            self._volatile = RuleSet([rule for rule in self.rules
+                                      if rule.volatile] +
+                                     list(self.author_rules), self,
+                                     self.version)
+        return self._volatile
+
+    def quarantined(self):
+        """Get the rules which are quarantined, and why, by filename"""
+        return dict((rule['_filename'], rule.quarantined)
+                    for rule in self.rules + self.author_rules
+                    if rule.quarantined is not None)
+
+    def reorder(self):
+        """Reorder the conditions of each rule by their recent stats"""
+        for rule in self.rules + self.author_rules:
+            rule.reorder()
+        logging.debug("Reordered conditions of %d rules" % len(self.rules))
+
+    def count(self, kind):
+        """Get the number of rules a thing of type kind is tried against"""
+        gated, ungated = self._types.get(kind, self._other)
+        indexes = set(ungated)
+        for conditions in gated.itervalues():
+            for gated_indexes in conditions.itervalues():
+                indexes.update(gated_indexes)
+        return len(indexes)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _candidates(self, values, scans):
+        """Get the indexes of the rules which may match thing, in order"""
+        gated, ungated = self._types.get(values.kind, self._other)
+        candidates = list(ungated)
+        for field, conditions in gated.iteritems():
+            try:
+                fieldvalue = values.text(field)
+            except AttributeError:
+                # The condition will be ignored, so can't rule anything out
+                for indexes in conditions.itervalues():
+                    candidates.extend(indexes)
+                continue
+            except TypeError:
+                continue
+            for condition in scans.conditions(field, fieldvalue):
+                candidates.extend(conditions.get(condition, ()))
+        return sorted(set(candidates))
+
+    def match(self, thing, values=None, profiler=None):
+        """Find the first rule matching thing. The ItemValues of thing may be
+        given, if they are needed afterwards, and a RuleProfiler to record
+        the time spent on each rule and condition.
+
+        Returns a tuple of the rule and its matches, or (None, None)"""
+        self._checked += 1
+        if self._checked % REORDER_INTERVAL == 0:
+            self.reorder()
+        if values is None:
+            values = ItemValues(thing)
+        values.verdicts = self.verdicts
+        scans = FieldScans(self._scanners)
+        if profiler is None:
+            candidates = self._candidates(values, scans)
+        else:
+            candidates = profiler.candidates(self._candidates, values, scans)
+        for index in candidates:
+            rule = self.rules[index]
+            logging.debug("Match %s against %s", thing.name, rule['_filename'])
+            if profiler is None:
+                matches = rule.match(values, scans)
+            else:
+                matches = profiler.rule(rule, values, scans)
+            if matches is not None:
+                return rule, matches
+        return None, None
+
 
 class RuleChangeHandler(PatternMatchingEventHandler):
 
@@ -45,27 +642,41 @@ class RuleChangeHandler(PatternMatchingEventHandler):
         self.rh = rh
         self.pattern = pattern
 
+    def on_created(self, event):
+        self.rh._changed(event.src_path)
+
     def on_deleted(self, event):
-        self.rh._remove_rule(event.src_path)
+        self.rh._changed(event.src_path)
 
     def on_modified(self, event):
-        self.rh._read_rule(event.src_path)
+        self.rh._changed(event.src_path)
 
     def on_moved(self, event):
         if fnmatch(event.src_path, self.pattern):
-            self.rh._remove_rule(event.src_path)
+            self.rh._changed(event.src_path)
         if fnmatch(event.dest_path, self.pattern):
-            self.rh._read_rule(event.dest_path)
+            self.rh._changed(event.dest_path)
 
 
 class RuleHandler(object):
-    _rules = {}
-    _rules_list = []
-    _addedfiles = []
-    _removedfiles = []
+    """
+    Keeps the rules in a directory, compiled into a RuleSet, up to date.
+
+    Changed files are collected for RELOAD_DELAY seconds after the first
+    change, then only those are read again and a new RuleSet is built in the
+    background and swapped in, so a lot of changes at once (like a git pull)
+    cause a single reload, and checking things is never held up or sees half
+    of a change.
+    """
     _observer = None
 
     def __init__(self, directory, fnmask='*.rule'):
+        self._rules = {}
+        self._ruleset = RuleSet([])
+        self._changes = set()
+        self._timer = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
         self._event_handler = RuleChangeHandler(self, fnmask)
         self.directory = directory
         self.fnmask = fnmask
@@ -81,7 +692,18 @@ class RuleHandler(object):
         """Get the current list of rules, ordered by filename.
 
         Returns a copy of the list - not the list itself, which is private"""
-        return list(self._rules_list)
+        return sorted(self._ruleset.rules + self._ruleset.author_rules,
+                      key=lambda rule: rule['_filename'])
+
+    @property
+    def ruleset(self):
+        """Get the current rules, compiled into a RuleSet"""
+        return self._ruleset
+
+    @property
+    def version(self):
+        """The version of the current RuleSet, increased on every reload"""
+        return self._ruleset.version
 
     @property
     def directory(self):
@@ -101,35 +723,89 @@ class RuleHandler(object):
     @directory.deleter
     def directory(self):
         del(self._directory)
-        self._rules = []
+        self._rules = {}
         self._observer.stop()
         self._observer.join()
         del(self._observer)
 
-    def _update_rules_list(self):
-        keys = self._rules.keys()
-        self._rules_list = []
-        for key in keys:
-            self._rules_list.append(self._rules[key])
-        self._rules_list.sort(lambda a, b: cmp(a['_filename'], b['_filename']))
+    def _update(self, rules):
+        """Swap in rules, a new dict of rules by filename"""
+        self._rules = rules
+        ruleset = RuleSet(rules.values(), self._ruleset,
+                          self._ruleset.version + 1)
+        self._ruleset = ruleset
+        logging.info("Rules version %d: %d rules, %s" % (
+            ruleset.version, len(ruleset), ", ".join(
+                "%d for %ss" % (ruleset.count(kind), kind)
+                for kind in THING_TYPES) +
+            (", %d for authors" % len(ruleset.author_rules)
+             if ruleset.author_rules else "") +
+            (", %d quarantined" % len(ruleset.quarantined())
+             if ruleset.quarantined() else "")))
 
     def _read_all(self):
+        rules = {}
         for filename in glob(path.join(self.directory, self.fnmask)):
-            self._read_rule(filename)
-        self._update_rules_list()
+            rule = self._parse_rule(filename)
+            if rule is not None:
+                rules[rule['_filename']] = rule
+        with self._reload_lock:
+            self._update(rules)
+
+    def _changed(self, filename):
+        """Note that filename was changed, and reload the changed files
+        RELOAD_DELAY seconds after the first change"""
+        with self._lock:
+            self._changes.add(path.realpath(filename))
+            if self._timer is None:
+                self._timer = threading.Timer(RELOAD_DELAY, self._reload)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _reload(self):
+        with self._lock:
+            changes = self._changes
+            self._changes = set()
+            self._timer = None
+        with self._reload_lock:
+            rules = dict(self._rules)
+            for filename in sorted(changes):
+                if (path.isfile(filename) and
+                        fnmatch(path.basename(filename), self.fnmask)):
+                    rule = self._parse_rule(filename)
+                    if rule is not None:
+                        rules[filename] = rule
+                elif filename in rules:
+                    logging.info("Remove %s" % path.relpath(filename))
+                    del(rules[filename])
+            self._update(rules)
 
     def _remove_rule(self, filename):
         filename = path.realpath(filename)
         logging.info("Remove %s" % path.relpath(filename))
-        if filename in self._rules:
-            del(self._rules[filename])
-            self._update_rules_list()
+        with self._reload_lock:
+            if filename in self._rules:
+                rules = dict(self._rules)
+                del(rules[filename])
+                self._update(rules)
 
     def _read_rule(self, filename):
+        """Read filename and swap in the rules with it right away"""
+        rule = self._parse_rule(filename)
+        if rule is not None:
+            with self._reload_lock:
+                rules = dict(self._rules)
+                rules[rule['_filename']] = rule
+                self._update(rules)
+        return rule
+
+    def _parse_rule(self, filename):
+        """Read and compile the rule in filename. Returns None if it fails,
+        which is logged"""
         filename = path.realpath(filename)
         logging.info("Read %s" % path.relpath(filename))
         try:
-            rule = {u'_filename': filename}
+            rule = Rule({u'_filename': filename})
             isData = False
             for line in codecs.open(filename, 'r', 'utf-8'):
                 if isData:
@@ -145,8 +821,7 @@ class RuleHandler(object):
                     rule[key.lower().strip()] = value.strip()
             if u'content' in rule:
                 rule[u'content'] = rule[u'content'].strip()
-            self._rules[filename] = rule
-            self._update_rules_list()
+            rule.compile()
             return rule
         except Exception, e:
             logging.warning("Failed reading {0}: {1}".format(
@@ -156,7 +831,6 @@ class RuleHandler(object):
 if __name__ == "__main__":
     from pprint import pprint
     import sys
-    import time
     logging.basicConfig(level=logging.DEBUG,
                         format="[%(asctime)s] %(levelname)-7s %(message)s")
     rh = RuleHandler(sys.argv[1])
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import re
+import sre_constants
+import sre_parse
+
+# Longer literals are truncated - a prefix of a required string is required too
+MAX_LITERAL_LENGTH = 64
+
+
+def required_literals(regex):
+    """Get a set of lowercase strings, one of which occurs in any text matched
+    by the compiled regex, or None if no such set can be determined"""
+    if regex.flags & (re.LOCALE | re.UNICODE):
+        return None
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+    return _required(parsed)
+
+
+def _selectivity(literals):
+    return (min(len(l) for l in literals), -len(literals))
+
+
+def _required(subpattern):
+    """All items of a sequence must match, so any one of the requirements
+    found in it will do. Pick the most selective one."""
+    requirements = []
+    run = []
+    for op, av in subpattern:
+        if op == sre_constants.LITERAL and av < 128:
+            run.append(unichr(av).lower())
+            continue
+        if run:
+            requirements.append(set([u''.join(run)[:MAX_LITERAL_LENGTH]]))
+            run = []
+        required = None
+        if op == sre_constants.SUBPATTERN:
+            required = _required(av[-1])
+        elif op == sre_constants.BRANCH:
+            required = set()
+            for alternative in av[1]:
+                literals = _required(alternative)
+                if literals is None:
+                    required = None
+                    break
+                required |= literals
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if av[0] >= 1:
+                required = _required(av[2])
+        if required:
+            requirements.append(required)
+    if run:
+        requirements.append(set([u''.join(run)[:MAX_LITERAL_LENGTH]]))
+    if not requirements:
+        return None
+    return max(requirements, key=_selectivity)
+
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+_MAXREPEAT = getattr(sre_constants, 'MAXREPEAT', 65535)
+_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: u'0123456789',
+    sre_constants.CATEGORY_WORD: u'abcdefghijklmnopqrstuvwxyz0123456789_',
+    sre_constants.CATEGORY_SPACE: u' \t\n\r\f\v',
+}
+
+
+def backtracking_hazard(regex):
+    """Get a description of a part of the compiled regex which can make it
+    take exponential (or high polynomial) time on a long text, like "(a+)+b",
+    or None if none was found.
+
+    This only recognizes the usual forms: a repeated group with a repeat
+    inside which can match the same text as the rest of the group, and a
+    repeated alternation whose alternatives can start with the same
+    characters (as far as they can be told), or like (a|aa)+, can match
+    nothing before the other alternatives could start."""
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+    return _hazard(parsed)
+
+
+def _children(op, av):
+    if op == sre_constants.SUBPATTERN:
+        return [av[-1]]
+    elif op == sre_constants.BRANCH:
+        return av[1]
+    elif op in _REPEATS:
+        return [av[2]]
+    elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        return [av[1]]
+    return []
+
+
+def _flatten(subpattern):
+    """Get the items of subpattern, looking into groups which are all of it"""
+    items = list(subpattern)
+    while len(items) == 1 and items[0][0] == sre_constants.SUBPATTERN:
+        items = list(items[0][1][-1])
+    return items
+
+
+def _hazard(subpattern):
+    for op, av in subpattern:
+        if op in _REPEATS and av[1] > 1:
+            items = _flatten(av[2])
+            for index, (inner, inner_av) in enumerate(items):
+                if inner == sre_constants.BRANCH:
+                    # What comes after the alternatives, or the next repeat
+                    following = _prefix(items[index + 1:] or items)
+                    if _overlap(inner_av[1], following):
+                        return u"repeated alternatives which overlap"
+                if (inner not in _REPEATS or inner_av[1] != _MAXREPEAT or
+                        inner_av[2].getwidth()[0] == 0):
+                    continue
+                chars = _first(inner_av[2])
+                if all(_overlaps(chars, _first([other]))
+                       for other in items[:index] + items[index + 1:]
+                       if _width(av[2], other)[0] > 0):
+                    return u"nested quantifiers"
+        for child in _children(op, av):
+            hazard = _hazard(child)
+            if hazard is not None:
+                return hazard
+    return None
+
+
+def _width(subpattern, item):
+    return sre_parse.SubPattern(subpattern.pattern, [item]).getwidth()
+
+
+def _overlaps(chars, other):
+    return chars is None or other is None or bool(chars & other)
+
+
+def _same_start(prefix, other):
+    """Whether text matched by subpatterns with these _prefix()es may start
+    the same"""
+    if prefix is None or other is None:
+        return True
+    return all(chars & other_chars
+               for chars, other_chars in zip(prefix, other))
+
+
+def _overlap(alternatives, following):
+    """Whether any two of alternatives may match text starting with the same
+    characters, or both match nothing.
+
+    sre_parse moves a prefix which all alternatives share out of them, so
+    (a|aa) becomes a(|a). If one of them can match nothing, the others
+    overlap with what may follow them, the _prefix() following."""
+    prefixes = []
+    optional = False
+    for alternative in alternatives:
+        empty = alternative.getwidth()[1] == 0
+        optional = optional or alternative.getwidth()[0] == 0
+        prefix = None if empty else _prefix(alternative)
+        for other_empty, other in prefixes:
+            if empty or other_empty:
+                if empty and other_empty:
+                    return True
+            elif _same_start(prefix, other):
+                return True
+        prefixes.append((empty, prefix))
+    return optional and any(not empty and _same_start(prefix, following)
+                            for empty, prefix in prefixes)
+
+
+def _prefix(subpattern):
+    """Get the sets of (lowercase) characters each of the first characters
+    of text matched by subpattern can be, as far as that can be determined,
+    or None if not even the first can be"""
+    chars = []
+    for op, av in _flatten(subpattern):
+        first = _first([(op, av)])
+        if first is None:
+            break
+        chars.append(first)
+        if op not in (sre_constants.LITERAL, sre_constants.IN):
+            # May match any number of characters
+            break
+    return chars or None
+
+
+def _first(subpattern):
+    """Get the set of (lowercase) characters text matched by subpattern can
+    start with, or None if it can't be determined"""
+    items = _flatten(subpattern)
+    if not items:
+        return None
+    op, av = items[0]
+    if op == sre_constants.LITERAL:
+        return set([unichr(av).lower()])
+    elif op == sre_constants.IN:
+        chars = set()
+        for in_op, in_av in av:
+            if in_op == sre_constants.LITERAL:
+                chars.add(unichr(in_av).lower())
+            elif in_op == sre_constants.RANGE and in_av[1] - in_av[0] < 256:
+                chars.update(unichr(c).lower()
+                             for c in range(in_av[0], in_av[1] + 1))
+            elif in_op == sre_constants.CATEGORY and in_av in _CATEGORIES:
+                chars.update(_CATEGORIES[in_av])
+            else:
+                return None
+        return chars
+    elif op == sre_constants.BRANCH:
+        chars = set()
+        for alternative in av[1]:
+            first = _first(alternative)
+            if first is None:
+                return None
+            chars |= first
+        return chars
+    elif op in _REPEATS and av[0] >= 1:
+        return _first(av[2])
+    return None
+
+
+def _trie_pattern(node):
+    alternatives = [re.escape(char) + _trie_pattern(child)
+                    for char, child in sorted(node.iteritems()) if char]
+    if not alternatives:
+        return ''
+    if len(alternatives) == 1:
+        pattern = alternatives[0]
+    else:
+        pattern = '|'.join(alternatives)
+    if '' in node:
+        return '(?:%s)?' % pattern
+    elif len(alternatives) == 1:
+        return pattern
+    return '(?:%s)' % pattern
+
+
+class KeywordScanner(object):
+    """Finds which of a number of conditions on the same field may match a
+    text in a single pass.
+
+    The literals required by all the conditions are compiled into one
+    trie-shaped pattern. Only conditions whose literals occur in the text need
+    to have their own regex run, to confirm the match and get the groups."""
+
+    def __init__(self, conditions):
+        self.conditions = frozenset(conditions)
+        self._conditions = {}
+        trie = {}
+        for condition in conditions:
+            for literal in condition.literals:
+                self._conditions.setdefault(literal, []).append(condition)
+                node = trie
+                for char in literal:
+                    node = node.setdefault(char, {})
+                node[''] = True
+        # At each position the longest literal starting there is found. The
+        # literals which are prefixes of it occur at the same position.
+        self._prefixes = {}
+        for literal in self._conditions:
+            self._prefixes[literal] = [literal[:i]
+                                       for i in range(1, len(literal) + 1)
+                                       if literal[:i] in self._conditions]
+        self._regex = re.compile(u'(?=(%s))' % _trie_pattern(trie))
+
+    def scan(self, text):
+        """Get the set of conditions which may match text"""
+        found = set(m.group(1) for m in self._regex.finditer(text.lower()))
+        conditions = set()
+        for literal in found:
+            for prefix in self._prefixes[literal]:
+                conditions.update(self._conditions[prefix])
+        return conditions
+
+
+class FieldScans(object):
+    """The results of scanning the fields of one thing, done lazily the first
+    time a condition on the field is evaluated"""
+
+    def __init__(self, scanners):
+        self._scanners = scanners
+        self._results = {}
+
+    def conditions(self, field, text):
+        """Get the set of conditions on field which may match text, which is
+        the value of the field for this thing"""
+        if field not in self._results:
+            self._results[field] = self._scanners[field].scan(text)
+        return self._results[field]
+
+    def possible(self, condition, text):
+        """Whether condition may match text"""
+        if condition.literals is None:
+            return True
+        return condition in self.conditions(condition.field, text)
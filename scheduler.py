@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import logging
+import math
+import threading
+import time
+
+# Listings return at most this many things per request
+PAGE_SIZE = 100
+
+
+class AdaptivePolicy(object):
+    """
+    Adapts the poll interval and page size of each stream to how fast new
+    things arrive in it.
+
+    The arrival rate of each stream is tracked as a moving average, and the
+    stream is polled often enough to get about batch new things per poll,
+    but no more often than min_interval and no less than max_interval
+    seconds. A stream whose fetch didn't reach the placeholder is polled as
+    soon as possible with the largest page size. Intervals are stretched if
+    the streams together would make more than budget requests a minute,
+    counting the extra pages each stream recently needed to catch up.
+    """
+
+    def __init__(self, streams, budget=20.0, min_interval=5.0,
+                 max_interval=120.0, batch=25, min_limit=25, alpha=0.3):
+        self.streams = streams
+        self.budget = budget
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.batch = batch
+        self.min_limit = min_limit
+        self.alpha = alpha
+        self._rates = {}
+        self._previous = {}
+        self._paged = {}
+        self._extra = {}
+        self._lock = threading.Lock()
+
+    def pages(self, stream, extra=True):
+        """Number of requests a fetch of stream will probably make. Without
+        extra, just the first pages, not the extra pages the stream fetches
+        when it has to catch up (which take their own tokens)."""
+        pages = max(1, int(math.ceil(stream.limit / float(PAGE_SIZE))))
+        if extra:
+            return pages + self._extra.get(stream.name, 0.0)
+        return pages
+
+    def update(self, stream):
+        """Adjust stream after it has been fetched"""
+        with self._lock:
+            self._update(stream)
+
+    def _update(self, stream):
+        extra = stream.paged - self._paged.get(stream.name, 0)
+        self._paged[stream.name] = stream.paged
+        self._extra[stream.name] = self.alpha * extra + (1 - self.alpha) * \
+            self._extra.get(stream.name, extra)
+        previous = self._previous.get(stream.name)
+        self._previous[stream.name] = stream.fetched
+        if previous is None or stream.fetched is None:
+            return
+        elapsed = max(1.0, stream.fetched - previous)
+        rate = stream.new / elapsed
+        if stream.name in self._rates:
+            rate = self.alpha * rate + (1 - self.alpha) * \
+                self._rates[stream.name]
+        self._rates[stream.name] = rate
+
+        if stream.reached is False:
+            # Fell behind, catch up
+            stream.interval = self.min_interval
+            stream.limit = stream.max_limit
+        else:
+            interval = self.batch / rate if rate > 0 else self.max_interval
+            stream.interval = min(self.max_interval,
+                                  max(self.min_interval, interval))
+            # The first page of the modqueue is always fetched, see Stream
+            if not stream.is_modqueue:
+                expected = rate * stream.interval
+                stream.limit = min(stream.max_limit,
+                                   max(self.min_limit, int(expected * 2)))
+        self._rebalance()
+        logging.debug("Stream %s: %.2f things/s, polling every %.1f s, "
+                      "limit %d" % (stream.name, rate, stream.interval,
+                                    stream.limit))
+
+    def _rebalance(self):
+        demand = sum(self.pages(stream) * 60.0 / stream.interval
+                     for stream in self.streams)
+        if demand > self.budget:
+            factor = demand / self.budget
+            for stream in self.streams:
+                stream.interval = min(self.max_interval,
+                                      stream.interval * factor)
+
+    def summary(self):
+        return ", ".join("%s every %.1f s (limit %d, %.2f/s)" % (
+            stream.name, stream.interval, stream.limit,
+            self._rates.get(stream.name, 0.0)) for stream in self.streams)
+
+
+class Scheduler(object):
+    """
+    Polls each stream when it's due, according to its interval, and checks
+    the things by calling check(stream, things). If a policy is given it
+    adjusts the streams after every fetch, and if a token bucket is given
+    fetches wait for it.
+    """
+
+    def __init__(self, streams, check, policy=None, bucket=None):
+        self.streams = streams
+        self.check = check
+        self.policy = policy
+        self.bucket = bucket
+        self._due = dict((stream.name, 0.0) for stream in streams)
+
+    def poll(self, stream):
+        if self.bucket is not None:
+            pages = self.policy.pages(stream, False) if self.policy else 1
+            self.bucket.acquire(pages)
+        things = stream.fetch()
+        if self.policy is not None:
+            self.policy.update(stream)
+        self._due[stream.name] = time.time() + stream.interval
+        return things
+
+    def run(self, periodic=None, period=30.0):
+        """Poll the streams forever, calling periodic() every period
+        seconds"""
+        ran = time.time()
+        while True:
+            now = time.time()
+            if periodic is not None and now - ran >= period:
+                ran = now
+                periodic()
+                if self.policy is not None:
+                    logging.info("Polling %s" % self.policy.summary())
+            stream = min(self.streams, key=lambda s: self._due[s.name])
+            sleepfor = self._due[stream.name] - now
+            if sleepfor > 0:
+                if periodic is not None:
+                    sleepfor = min(sleepfor, max(0.0, ran + period - now))
+                time.sleep(sleepfor)
+                continue
+            self.check(stream, self.poll(stream))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import math
+import time
+
+MASK64 = (1 << 64) - 1
+
+
+def fullname_key(fullname):
+    """Turn a fullname like t1_c3v7f8u into an integer"""
+    kind, id36 = fullname.split('_', 1)
+    return int(id36, 36) << 4 | int(kind[1:])
+
+
+class BloomFilter(object):
+    """Fixed size set of integers, which may report false positives"""
+
+    def __init__(self, capacity, error_rate):
+        bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = 1 << max(3, int(math.ceil(math.log(bits, 2))))
+        self.hashes = max(1, int(round(self.size * math.log(2) / capacity)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self._count = 0
+
+    def _positions(self, key):
+        # splitmix64 finalizer, split in two for enhanced double hashing
+        h = (key ^ (key >> 30)) * 0xBF58476D1CE4E5B9 & MASK64
+        h = (h ^ (h >> 27)) * 0x94D049BB133111EB & MASK64
+        h ^= h >> 31
+        mask = self.size - 1
+        a = h & mask
+        b = h >> 32
+        for i in xrange(self.hashes):
+            yield a
+            a = (a + b) & mask
+            b += i
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self._count += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._bits[position >> 3] & 1 << (position & 7):
+                return False
+        return True
+
+    def __len__(self):
+        return self._count
+
+    def false_positive_rate(self):
+        return (1 - math.exp(-self.hashes * self._count /
+                             float(self.size))) ** self.hashes
+
+
+class IdSet(set):
+    """Exact set of integers, with the same interface as BloomFilter"""
+
+    def false_positive_rate(self):
+        return 0.0
+
+
+class SeenStore(object):
+    """
+    Set of thing fullnames which forgets them max_age seconds after they were
+    added.
+
+    Ids are kept as integers in a number of generations, each covering an
+    equal part of max_age. When the newest generation is too old a new one is
+    started and generations older than max_age are dropped. At most capacity
+    ids are held: a generation which fills up is rotated early. With bloom,
+    every generation is a BloomFilter of fixed size instead of an exact set,
+    trading a small false positive rate for a fixed amount of memory.
+    """
+
+    def __init__(self, max_age=3 * 86400, capacity=1000000, generations=8,
+                 bloom=False, error_rate=0.0001):
+        self.max_age = max_age
+        self.generations = generations
+        self.span = max_age / float(generations - 1)
+        self.generation_capacity = max(1, capacity // generations)
+        self.bloom = bloom
+        self.error_rate = error_rate
+        self.early_rotations = 0
+        # Anything added before this may have been forgotten
+        self.forgotten_before = 0
+        self._generations = []
+
+    def _new_generation(self, timestamp):
+        if self.bloom:
+            ids = BloomFilter(self.generation_capacity, self.error_rate)
+        else:
+            ids = IdSet()
+        self._generations.append((timestamp, ids))
+        while len(self._generations) > 1 and (
+                len(self._generations) > self.generations or
+                self._generations[1][0] <= timestamp - self.max_age):
+            self._generations.pop(0)
+            self.forgotten_before = self._generations[0][0]
+        return ids
+
+    def add(self, fullname, timestamp=None):
+        """Remember fullname, seen at timestamp (defaults to now)"""
+        if timestamp is None:
+            timestamp = time.time()
+        if timestamp < self.forgotten_before:
+            return
+        if not self._generations:
+            ids = self._new_generation(timestamp)
+        else:
+            start, ids = self._generations[-1]
+            if timestamp - start >= self.span:
+                ids = self._new_generation(timestamp)
+            elif len(ids) >= self.generation_capacity:
+                self.early_rotations += 1
+                ids = self._new_generation(timestamp)
+        ids.add(fullname_key(fullname))
+
+    def __contains__(self, fullname):
+        key = fullname_key(fullname)
+        for start, ids in reversed(self._generations):
+            if key in ids:
+                return True
+        return False
+
+    def __len__(self):
+        return sum(len(ids) for start, ids in self._generations)
+
+    def maybe_forgotten(self, created_utc):
+        """Whether a thing created at created_utc may have been added and
+        forgotten since. Only things created after the oldest remembered
+        generation started can be known not to have been seen."""
+        return created_utc < self.forgotten_before
+
+    def false_positive_rate(self):
+        """Estimated chance that a fullname never added is reported as seen"""
+        p = 1.0
+        for start, ids in self._generations:
+            p *= 1 - ids.false_positive_rate()
+        return 1 - p
+
+    def stats(self):
+        return {'size': len(self), 'generations': len(self._generations),
+                'early_rotations': self.early_rotations,
+                'false_positive_rate': self.false_positive_rate()}
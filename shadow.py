@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from Queue import Queue, Full, Empty
+from os import path
+from workers import WorkerPool, NEEDS_AUTHOR
+import json
+import logging
+import threading
+import time
+
+
+def _verdict(rule):
+    """Describe what a rule, or None, would do"""
+    if rule is None:
+        return None
+    return {'rule': path.basename(rule['_filename']),
+            'actions': [action.strip() for action in rule.actions]}
+
+
+class ShadowChecker(object):
+    """
+    Checks the things checked by the live rules against a second set of
+    rules, in a separate process, without performing any actions.
+
+    A thread sends the things to the process in batches of up to batchsize,
+    with the authors which are cached, and waits for the results. Authors
+    which aren't cached are never fetched for the shadow rules: things which
+    need one are unknown.
+
+    Whenever either set of rules matches a thing, or it's unknown, a line of
+    JSON is written to the report with what each would have done, and
+    whether they differ. If the process can't keep up, things are dropped
+    rather than holding up the live rules.
+    """
+
+    def __init__(self, rulehandlers, filename, maxsize=10000, batchsize=100):
+        self.rulehandlers = rulehandlers
+        self.batchsize = batchsize
+        self.stats = dict.fromkeys(('checked', 'live', 'shadow', 'different',
+                                    'unknown', 'dropped'), 0)
+        self._pool = WorkerPool(rulehandlers, 1, inline=0)
+        self._report = open(filename, 'a')
+        self._queue = Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name="shadow")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, thing, rule):
+        """Check thing, which matched rule (or None) of the live rules"""
+        try:
+            self._queue.put_nowait((thing, rule))
+        except Full:
+            self.stats['dropped'] += 1
+
+    def close(self, timeout=None):
+        """Wait for the queued things to be checked, for at most timeout
+        seconds, and close the report"""
+        self._queue.put((None, None))
+        self._thread.join(timeout)
+        self._pool.close()
+        self._report.close()
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = [self._queue.get()]
+            while len(batch) < self.batchsize:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            if batch[-1][0] is None:
+                batch.pop()
+                done = True
+            try:
+                self._check(batch)
+            except Exception, e:
+                logging.warning("Failed shadow checking %d things: %s" % (
+                    len(batch), e))
+
+    def _check(self, batch):
+        items = []
+        for thing, live in batch:
+            subreddit = thing.subreddit.display_name.lower()
+            rulehandler = self.rulehandlers.get(subreddit)
+            if rulehandler is not None:
+                items.append((rulehandler, thing))
+        results = dict((thing.name, result) for (rulehandler, thing), result
+                       in zip(items, self._pool.match(items, fetch=False)))
+        for thing, live in batch:
+            result = results.get(thing.name, (None, None))
+            self.stats['checked'] += 1
+            unknown = result is None or result == NEEDS_AUTHOR
+            shadow = None if unknown else result[0]
+            if live is None and shadow is None and not unknown:
+                continue
+            live = _verdict(live)
+            shadow = _verdict(shadow)
+            if unknown:
+                different = None
+            else:
+                different = (
+                    live is None or shadow is None or
+                    sorted(a.lower() for a in live['actions']) !=
+                    sorted(a.lower() for a in shadow['actions']))
+            self.stats['live'] += int(live is not None)
+            self.stats['shadow'] += int(shadow is not None)
+            self.stats['different'] += int(bool(different))
+            self.stats['unknown'] += int(unknown)
+            self._report.write(json.dumps({
+                'time': time.time(), 'thing': thing.name,
+                'subreddit': thing.subreddit.display_name.lower(),
+                'live': live, 'shadow': shadow, 'different': different,
+                'unknown': unknown}) + "\n")
+        self._report.flush()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from praw.objects import Comment, Submission
+
+
+class _Slotted(object):
+    """Base for small records with __slots__, which can be pickled"""
+    __slots__ = ()
+
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot))
+                    for cls in type(self).__mro__
+                    for slot in getattr(cls, '__slots__', ())
+                    if hasattr(self, slot))
+
+    def __setstate__(self, state):
+        for slot, value in state.iteritems():
+            setattr(self, slot, value)
+
+
+class AuthorSnapshot(_Slotted):
+    """The author of a ThingSnapshot. Age is set by modbot.decorate()"""
+    __slots__ = ('name', 'age')
+    kind = 'redditor'
+
+    def __init__(self, name):
+        self.name = name
+
+
+class SubredditSnapshot(_Slotted):
+    __slots__ = ('display_name',)
+
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class ThingSnapshot(_Slotted):
+    """
+    The parts of a comment or submission which rules can look at, copied
+    from the praw object once when it's fetched.
+
+    Unlike praw objects, a snapshot never fetches anything from reddit:
+    fields which weren't in the listing raise AttributeError. The praw
+    object has to be fetched again to act on the thing.
+    """
+    FIELDS = ('name', 'id', 'permalink', 'author', 'subreddit',
+              'created_utc', 'score', 'ups', 'downs', 'num_reports', 'body',
+              'selftext', 'title', 'domain', 'url', 'link_id', 'banned_by')
+    __slots__ = FIELDS
+    kind = None
+
+    def __init__(self, **data):
+        for key, value in data.iteritems():
+            if key in self.FIELDS:
+                setattr(self, key, value)
+        if ('permalink' not in data and 'link_id' in data and
+                data.get('subreddit') is not None):
+            # Comments don't have one, and praw would fetch the submission
+            self.permalink = 'http://www.reddit.com/r/%s/comments/%s/_/%s' % (
+                self.subreddit.display_name, self.link_id[3:], self.id)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.name)
+
+    def data(self):
+        """Get the fields as a JSON-able dict"""
+        data = self.__getstate__()
+        if data.get('author') is not None:
+            data['author'] = data['author'].name
+        if data.get('subreddit') is not None:
+            data['subreddit'] = data['subreddit'].display_name
+        return data
+
+
+class CommentSnapshot(ThingSnapshot):
+    __slots__ = ()
+    kind = 'comment'
+
+
+class SubmissionSnapshot(ThingSnapshot):
+    __slots__ = ()
+    kind = 'submission'
+
+
+SNAPSHOTS = {'t1': CommentSnapshot, 't3': SubmissionSnapshot}
+
+
+def make_snapshot(kind, data):
+    """Make a snapshot of kind (t1 or t3) from data, with author and
+    subreddit as names"""
+    data = dict(data)
+    if data.get('author') is not None:
+        data['author'] = AuthorSnapshot(data['author'])
+    if data.get('subreddit') is not None:
+        data['subreddit'] = SubredditSnapshot(data['subreddit'])
+    return SNAPSHOTS[kind](**data)
+
+
+def snapshot(thing):
+    """Get a snapshot of a praw Comment or Submission, without fetching
+    anything. Anything else, including snapshots, is returned as it is."""
+    if isinstance(thing, Comment):
+        cls = CommentSnapshot
+    elif isinstance(thing, Submission):
+        cls = SubmissionSnapshot
+    else:
+        return thing
+    data = dict((key, value) for key, value in vars(thing).iteritems()
+                if key in ThingSnapshot.FIELDS)
+    if data.get('author') is not None:
+        data['author'] = AuthorSnapshot(data['author'].name)
+    if data.get('subreddit') is not None:
+        data['subreddit'] = SubredditSnapshot(
+            data['subreddit'].display_name)
+    return cls(**data)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from snapshot import snapshot
+import logging
+import time
+
+# Reddit listings don't go back further than this many things
+MAX_DEPTH = 1000
+
+# The whole modqueue is paged through at least every this many fetches, in
+# case things further down changed
+FULL_SYNC_INTERVAL = 10
+
+
+def _reports(thing):
+    return getattr(thing, 'num_reports', None) or 0
+
+
+class Stream(object):
+    """
+    A listing which is polled for things to check, like the comments or the
+    modqueue of a subreddit.
+
+    Except for the modqueue, only things newer than the placeholder (the
+    newest thing from the last fetch) are fetched. The placeholder only
+    becomes the saved position in the stream once the things have been
+    checked, see done().
+
+    The modqueue keeps the things known to be in it in members, with their
+    number of reports. Only the first page is fetched, unless it changed,
+    then the whole queue is paged through (also every FULL_SYNC_INTERVAL
+    fetches). Only things which are new in the queue or have more reports
+    are returned, and things which left it are forgotten.
+
+    The stream is polled every interval seconds, fetching at most limit
+    things. After each fetch, new is the number of things which weren't
+    returned by the previous fetch, and reached tells whether the placeholder
+    was reached (or None if there was no placeholder).
+
+    If more than limit things arrived since the last fetch, older pages are
+    fetched until the placeholder is reached, as far back as reddit allows.
+    If it still isn't reached, there's a gap of things which can't be
+    checked: gaps counts those, and skipped estimates how many things were
+    in them. paged counts the extra pages fetched to catch up. If a
+    TokenBucket is given as bucket, each extra page waits for a token.
+    """
+
+    def __init__(self, name, listing, limit=100, first_limit=100,
+                 is_modqueue=False, checkpoint=None, interval=30.0,
+                 bucket=None):
+        self.name = name
+        self.is_modqueue = is_modqueue
+        self.limit = limit
+        self.max_limit = limit
+        self.first_limit = first_limit
+        self.interval = interval
+        self.checkpoint = checkpoint
+        self.bucket = bucket
+        self.fetched = None
+        self.new = 0
+        self.reached = None
+        self.placeholder = None
+        self.paged = 0
+        self.gaps = 0
+        self.skipped = 0
+        self.members = {}
+        self.syncs = 0
+        self._placeholder_created = None
+        self._first = None
+        self._forget = False
+        self._fetches = 0
+        if checkpoint is not None and not is_modqueue:
+            self.placeholder = checkpoint.cursor(name)
+        self._listing = listing
+
+    def fetch(self):
+        """Get snapshots of the new things in the stream, newest first"""
+        try:
+            if self.is_modqueue:
+                things = list(self._listing(limit=self.limit))
+            elif self.placeholder is None:
+                things = list(self._listing(limit=self.first_limit))
+            else:
+                things = list(self._listing(place_holder=self.placeholder,
+                                            limit=self.limit))
+        except Exception, e:
+            logging.warning("Failed fetching %s: %s" % (self.name, e))
+            return []
+        things = [snapshot(thing) for thing in things]
+        self.fetched = time.time()
+        if self.is_modqueue:
+            return self._sync(things)
+
+        self.reached = None
+        if self.placeholder is not None:
+            self.reached = any(thing.id == self.placeholder
+                               for thing in things)
+            if not self.reached and things:
+                if not self._passed(things[-1]):
+                    things = self._catch_up(things)
+                self.reached = self._passed(things[-1])
+                if not self.reached:
+                    self._gap(things)
+                elif things[-1].id != self.placeholder:
+                    # Don't return the things before the deleted placeholder
+                    things = [thing for thing in things
+                              if not self._passed(thing)]
+        self.new = sum(1 for thing in things if thing.id != self.placeholder)
+        if things:
+            self.placeholder = things[0].id
+            self._placeholder_created = things[0].created_utc
+        return things
+
+    def _catch_up(self, things):
+        """Fetch older pages after things until the placeholder is reached,
+        or the listing ends"""
+        things = list(things)
+        while len(things) < MAX_DEPTH:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                page = [snapshot(thing) for thing in self._listing(
+                    place_holder=self.placeholder,
+                    limit=min(self.max_limit, MAX_DEPTH - len(things)),
+                    params={'after': things[-1].name})]
+            except Exception, e:
+                logging.warning("Failed fetching older %s: %s" % (self.name,
+                                                                  e))
+                break
+            self.paged += 1
+            things.extend(page)
+            if not page or self._passed(page[-1]):
+                break
+        logging.info("Caught up %d things in %s in %d pages" % (
+            len(things), self.name, self.paged))
+        return things
+
+    def _sync(self, things):
+        """Update the members of the modqueue, given its first page, and get
+        the things to check"""
+        if self._forget:
+            # Cleared first, so a forget() from now on is seen next time
+            self._forget = False
+            self.members = {}
+            self._first = None
+        first = [(thing.name, _reports(thing)) for thing in things]
+        changed = first != self._first
+        self._first = first
+        self._fetches += 1
+        if not changed and self._fetches % FULL_SYNC_INTERVAL:
+            self.new = 0
+            return []
+        complete = True
+        if len(things) >= self.limit:
+            things, complete = self._page(things)
+        self.syncs += 1
+        members = {}
+        fresh = []
+        for thing in things:
+            if thing.name in members:
+                continue
+            reports = members[thing.name] = _reports(thing)
+            if reports > self.members.get(thing.name, -1):
+                fresh.append(thing)
+        if not complete:
+            # Things further down may still be there
+            for name, reports in self.members.iteritems():
+                members.setdefault(name, reports)
+        self.members = members
+        self.new = len(fresh)
+        return fresh
+
+    def _page(self, things):
+        """Fetch the rest of the modqueue after things, as far as reddit
+        allows. Returns all the things and whether the end was reached."""
+        things = list(things)
+        while len(things) < MAX_DEPTH:
+            limit = min(self.max_limit, MAX_DEPTH - len(things))
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                page = [snapshot(thing) for thing in self._listing(
+                    limit=limit, params={'after': things[-1].name})]
+            except Exception, e:
+                logging.warning("Failed fetching more of %s: %s" % (
+                    self.name, e))
+                return things, False
+            self.paged += 1
+            things.extend(page)
+            if len(page) < limit:
+                break
+        logging.info("Synced %d things in %s" % (len(things), self.name))
+        return things, True
+
+    def forget(self):
+        """Forget the members of the modqueue, so the next fetch returns
+        all of it. May be called while another thread fetches: the members
+        are only touched by fetch()."""
+        self._forget = True
+
+    def _passed(self, thing):
+        """Whether thing is the placeholder or older, in case the
+        placeholder itself was deleted"""
+        return thing.id == self.placeholder or (
+            self._placeholder_created is not None and
+            thing.created_utc < self._placeholder_created)
+
+    def _gap(self, things):
+        """Note that the things between the placeholder and the oldest of
+        things could not be fetched"""
+        self.gaps += 1
+        skipped = 0
+        if self._placeholder_created is not None and len(things) > 1:
+            # Assume they arrived at the rate things just did
+            span = things[0].created_utc - things[-1].created_utc
+            gap = things[-1].created_utc - self._placeholder_created
+            if span > 0 and gap > 0:
+                skipped = int(gap * len(things) / span)
+        self.skipped += skipped
+        logging.warning("Gap in %s: %s not reached, about %d things "
+                        "skipped" % (self.name, self.placeholder, skipped))
+
+    def done(self, things):
+        """Mark things, as returned by fetch(), as checked"""
+        if things and self.checkpoint is not None and not self.is_modqueue:
+            self.checkpoint.set_cursor(self.name, things[0].id)
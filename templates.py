@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from string import Formatter
+
+_FORMATTER = Formatter()
+
+
+class Template(object):
+    """
+    A new style python format string, parsed once so formatting it only has
+    to look up and format the fields. Behaves like format(**kwargs), and
+    raises the same exceptions for bad templates and missing fields.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self._parts = list(_FORMATTER.parse(text))
+
+    def format(self, *args, **kwargs):
+        result = []
+        auto = 0
+        for literal, field, spec, conversion in self._parts:
+            if literal:
+                result.append(literal)
+            if field is None:
+                continue
+            if field == '':
+                field = str(auto)
+                auto += 1
+            obj, first = _FORMATTER.get_field(field, args, kwargs)
+            obj = _FORMATTER.convert_field(obj, conversion)
+            if spec and '{' in spec:
+                spec = _FORMATTER.vformat(spec, args, kwargs)
+            result.append(_FORMATTER.format_field(obj, spec))
+        return u''.join(result)
@@ -28,8 +28,10 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+from authors import AUTHOR_CACHE
 from pprint import pprint
-from rules import RuleHandler
+from rules import RuleHandler, RuleSet
+from snapshot import snapshot
 import argparse
 import logging
 import modbot
@@ -46,7 +48,7 @@ modbot.performaction = myperformaction
 def testrule(rule, thing):
     rh = RuleHandler('/tmp', '__NO_MATCHES__')
     rule = rh._read_rule(rule)
-    return modbot.matchrules(thing, [rule])
+    return modbot.matchrules(snapshot(thing), RuleSet([rule]))
 
 
 if __name__ == "__main__":
@@ -57,6 +59,8 @@ if __name__ == "__main__":
     parser.add_argument('url')
     args = parser.parse_args()
     r = praw.Reddit('%s/%s' % (modbot.NAME, modbot.VERSION))
+    # The snapshot of the thing can't fetch its author itself
+    AUTHOR_CACHE.fetch = r.get_redditor
     logging.basicConfig(level=logging.DEBUG,
             format="[%(asctime)s] %(levelname)-7s %(message)s")
     logging.info("Started, getting thing")
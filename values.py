@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from authors import AUTHOR_CACHE
+from datetime import datetime
+from decorators import RequiresType
+from praw.objects import Submission, Comment, Redditor
+from snapshot import AuthorSnapshot, CommentSnapshot, SubmissionSnapshot
+from snapshot import ThingSnapshot
+
+# Fields which require additional hits to the reddit api
+NETWORK_FIELDS = ('userage', 'userkarma', 'authorflags')
+
+# Fields given by the author rules (see verdicts.py), not by the thing itself
+VERDICT_FIELDS = ('authorflags',)
+
+# Fields which change after a thing was posted, so it may match a rule later
+VOLATILE_FIELDS = ('score', 'upvotes', 'downvotes', 'numreports')
+
+# Fields with integer values, which can be compared as numbers
+NUMERIC_FIELDS = ('score', 'upvotes', 'downvotes', 'numreports', 'bodylength',
+                  'userage', 'userkarma')
+
+
+# Things can be praw objects or snapshots of them
+COMMENTS = (Comment, CommentSnapshot)
+SUBMISSIONS = (Submission, SubmissionSnapshot)
+REDDITORS = (Redditor, AuthorSnapshot)
+
+
+def thing_kind(thing):
+    """Get the type of thing, as the Type field has it"""
+    if isinstance(thing, (ThingSnapshot, AuthorSnapshot)):
+        return thing.kind
+    return type(thing).__name__.lower()
+
+
+class ValueGetter:
+    """
+    Simplify getting a value from a thing, using a common name for different
+    types of things, regardless of how the value is retrieved.
+    """
+    @RequiresType(*(SUBMISSIONS + COMMENTS + REDDITORS), position=2)
+    def username(self, thing):
+        if not isinstance(thing, REDDITORS):
+            thing = thing.author
+        return thing.name
+
+    @RequiresType(*(SUBMISSIONS + COMMENTS), position=2)
+    def numreports(self, thing):
+        return thing.num_reports
+
+    @RequiresType(*SUBMISSIONS, position=2)
+    def domain(self, thing):
+        return thing.domain
+
+    @RequiresType(*SUBMISSIONS, position=2)
+    def title(self, thing):
+        return thing.title
+
+    @RequiresType(*SUBMISSIONS, position=2)
+    def url(self, thing):
+        return thing.url
+
+    @RequiresType(*(SUBMISSIONS + COMMENTS), position=2)
+    def upvotes(self, thing):
+        return thing.ups
+
+    @RequiresType(*(SUBMISSIONS + COMMENTS), position=2)
+    def downvotes(self, thing):
+        return thing.downs
+
+    @RequiresType(*(SUBMISSIONS + COMMENTS), position=2)
+    def score(self, thing):
+        return thing.score
+
+    def type(self, thing):
+        return thing_kind(thing)
+
+    @RequiresType(*(SUBMISSIONS + COMMENTS), position=2)
+    def body(self, thing):
+        if isinstance(thing, COMMENTS):
+            return thing.body
+        else:
+            return thing.selftext
+
+    @RequiresType(*(SUBMISSIONS + COMMENTS), position=2)
+    def bodylength(self, thing):
+        return len(self.body.function(self, thing))
+
+    @RequiresType(*(SUBMISSIONS + COMMENTS), position=2)
+    def dayhour(self, thing):
+        return datetime.fromtimestamp(thing.created_utc).strftime("%a-%H")
+
+    @RequiresType(*(SUBMISSIONS + COMMENTS + REDDITORS), position=2)
+    def userage(self, thing):
+        if not isinstance(thing, REDDITORS):
+            thing = thing.author
+        profile = AUTHOR_CACHE.get(thing)
+        created = datetime.utcfromtimestamp(profile.created_utc)
+        now = datetime.utcnow()
+        return (now - created).days
+
+    @RequiresType(*(SUBMISSIONS + COMMENTS + REDDITORS), position=2)
+    def userkarma(self, thing):
+        if not isinstance(thing, REDDITORS):
+            thing = thing.author
+        return AUTHOR_CACHE.get(thing).karma
+
+
+# The names of the types of things, as the Type field has them
+THING_TYPES = ('submission', 'comment', 'redditor')
+
+# The names of the types of things which have each field, or None if all of
+# them have it
+FIELD_TYPES = dict(
+    (name, tuple(set(cls.kind
+                     if issubclass(cls, (ThingSnapshot, AuthorSnapshot))
+                     else cls.__name__.lower() for cls in getter.types))
+           if hasattr(getter, 'types') else None)
+    for name, getter in vars(ValueGetter).iteritems()
+    if not name.startswith('_'))
+FIELD_TYPES['authorflags'] = ('submission', 'comment')
+
+
+class ItemValues(object):
+    """
+    The field values of a single thing. Each field is computed at most once,
+    the first time a rule needs it, and then shared by all rules the thing is
+    matched against.
+
+    The verdict fields are looked up in verdicts, the AuthorVerdicts of the
+    RuleSet the thing is being matched against, every time.
+    """
+    # The type is checked against FIELD_TYPES, so skip RequiresType
+    _getters = dict(
+        (name, getattr(getter, 'function', getter).__get__(ValueGetter()))
+        for name, getter in vars(ValueGetter).iteritems()
+        if not name.startswith('_'))
+
+    def __init__(self, thing):
+        self.thing = thing
+        self.kind = thing_kind(thing)
+        self.verdicts = None
+        self._values = {}
+        self._texts = {}
+
+    def value(self, field):
+        """Get the value of field. Raises AttributeError if it can't be
+        retrieved and TypeError if the thing doesn't have the field, every
+        time it's asked for."""
+        if field in VERDICT_FIELDS:
+            if self.kind not in FIELD_TYPES[field]:
+                raise TypeError("A %s has no %s" % (self.kind, field))
+            if self.verdicts is None:
+                return u''
+            return self.verdicts.flags(self.thing)
+        try:
+            value = self._values[field]
+        except KeyError:
+            types = FIELD_TYPES[field]
+            if types is not None and self.kind not in types:
+                value = _Unavailable(TypeError("A %s has no %s" % (self.kind,
+                                                                   field)))
+            else:
+                try:
+                    value = self._getters[field](self.thing)
+                except (AttributeError, TypeError), e:
+                    value = _Unavailable(e)
+            self._values[field] = value
+        if isinstance(value, _Unavailable):
+            raise value.error
+        return value
+
+    def text(self, field):
+        """Get the value of field as unicode, for matching against"""
+        if field in VERDICT_FIELDS:
+            return self.value(field)
+        try:
+            return self._texts[field]
+        except KeyError:
+            text = self._texts[field] = unicode(self.value(field))
+            return text
+
+
+class _Unavailable(object):
+    def __init__(self, error):
+        self.error = error
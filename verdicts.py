@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from authors import AUTHOR_CACHE
+from collections import OrderedDict
+from values import ItemValues
+import threading
+import time
+
+
+class AuthorVerdicts(object):
+    """
+    The flags the author rules of a RuleSet give to authors, for the
+    Authorflags field of the item rules.
+
+    An author is matched against all the author rules the first time one of
+    their things needs it, and the flags of the matching rules are kept for
+    as long as the author cache keeps their profile, so a spammer posting 200
+    comments is only looked at once. The verdicts are kept until the author
+    rules change.
+    """
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self._verdicts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.evaluations = 0
+
+    def __len__(self):
+        return len(self._verdicts)
+
+    def flags(self, thing):
+        """Get the flags of the author of thing, sorted and separated by
+        spaces. Deleted authors have no flags."""
+        author = thing.author
+        if author is None or not self.rules:
+            return u''
+        key = author.name.lower()
+        now = time.time()
+        with self._lock:
+            verdict = self._verdicts.pop(key, None)
+            if verdict is not None and now - verdict[1] < AUTHOR_CACHE.ttl:
+                self._verdicts[key] = verdict
+                self.hits += 1
+                return verdict[0]
+        values = ItemValues(author)
+        flags = set()
+        for rule in self.rules:
+            if rule.match(values) is not None:
+                flags.update(rule.flags)
+        flags = u' '.join(sorted(flags))
+        with self._lock:
+            self.evaluations += 1
+            self._verdicts[key] = (flags, now)
+            while len(self._verdicts) > AUTHOR_CACHE.size:
+                self._verdicts.popitem(last=False)
+        return flags
+
+    def stats(self):
+        return {'size': len(self._verdicts), 'hits': self.hits,
+                'evaluations': self.evaluations}
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# vim: set fileencoding=UTF-8 :
+
+# Copyright (c) 2012, Jonas Häggqvist <rasher@rasher.dk>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * Neither the name of the program nor the names of its contributors may be
+#   used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from authors import AUTHOR_CACHE, AuthorProfile
+from snapshot import AuthorSnapshot, SubredditSnapshot, ThingSnapshot
+from snapshot import SNAPSHOTS
+from values import ItemValues
+import logging
+import multiprocessing
+import rules
+import signal
+import threading
+import time
+
+# A worker which has been matching a thing against one rule for longer than
+# this (or the REGEX_BUDGET of each of its conditions, if that's more) is
+# killed, and the rule quarantined
+KILL_AFTER = 0.5
+
+# Seconds between looks at what the workers are doing
+WATCH_INTERVAL = 0.05
+
+# The result for a thing whose rules need an author which isn't cached
+NEEDS_AUTHOR = 'author'
+
+# Snapshot classes by kind, and the snapshots of the fields of snapshots
+# which are sent as just a name
+_KINDS = dict((cls.kind, cls) for cls in SNAPSHOTS.itervalues())
+_NAMED = {'author': (AuthorSnapshot, 'name'),
+          'subreddit': (SubredditSnapshot, 'display_name')}
+
+# The RuleSets the workers check things against, by directory. Set before
+# the workers are started, so they inherit them.
+_RULESETS = {}
+
+# The rules a worker has reported as quarantined, by directory
+_QUARANTINED = {}
+
+# Held while setting the above for new workers, as there may be more than
+# one WorkerPool
+_FORK_LOCK = threading.Lock()
+
+# The number of each rule of _RULESETS, by id
+_INDEX = {}
+
+# Shared with the parent: for each worker, the number of the rule it's
+# matching a thing against and since when, or 0 if it isn't
+_SLOTS = None
+_NEXT_SLOT = None
+_slot = None
+
+
+class NeedsParent(Exception):
+    """Raised in a worker when a rule needs something only the parent
+    process can do, like fetching an author from reddit"""
+
+
+def _needs_parent(name):
+    raise NeedsParent(name)
+
+
+def _trace(rule):
+    _SLOTS[2 * _slot] = _INDEX[id(rule)]
+    _SLOTS[2 * _slot + 1] = time.time()
+
+
+def _pack(thing):
+    """Get a snapshot as its kind, a bit mask of the fields it has and
+    their values, which is several times quicker to pickle. Anything else is
+    sent as it is."""
+    if not isinstance(thing, ThingSnapshot):
+        return thing
+    mask = 0
+    values = []
+    for i, field in enumerate(ThingSnapshot.FIELDS):
+        try:
+            value = getattr(thing, field)
+        except AttributeError:
+            continue
+        if value is not None and field in _NAMED:
+            value = getattr(value, _NAMED[field][1])
+        mask |= 1 << i
+        values.append(value)
+    return thing.kind, mask, values
+
+
+def _unpack(packed):
+    """Get the snapshot packed by _pack()"""
+    if not isinstance(packed, tuple):
+        return packed
+    kind, mask, values = packed
+    thing = _KINDS[kind].__new__(_KINDS[kind])
+    values = iter(values)
+    for i, field in enumerate(ThingSnapshot.FIELDS):
+        if mask & 1 << i:
+            value = next(values)
+            if value is not None and field in _NAMED:
+                value = _NAMED[field][0](value)
+            setattr(thing, field, value)
+    return thing
+
+
+def _restoring(flags):
+    """Wrap AuthorVerdicts.flags, which matches the author rules within an
+    Authorflags condition of an item rule, to trace the item rule again
+    afterwards"""
+    def wrapped(thing):
+        index = _SLOTS[2 * _slot]
+        started = _SLOTS[2 * _slot + 1]
+        try:
+            return flags(thing)
+        finally:
+            _SLOTS[2 * _slot] = index
+            _SLOTS[2 * _slot + 1] = started
+    return wrapped
+
+
+def _init_worker():
+    global _slot
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    AUTHOR_CACHE.fetch = _needs_parent
+    AUTHOR_CACHE.on_fetch = None
+    # The parent has other threads, which may have held these locks when it
+    # forked, and never will release them in this process
+    AUTHOR_CACHE._lock = threading.Lock()
+    shared = set(ruleset.verdicts for ruleset in _RULESETS.itervalues())
+    for verdicts in shared:
+        verdicts._lock = threading.Lock()
+        verdicts.flags = _restoring(verdicts.flags)
+    logging._lock = threading.RLock()
+    for handler in logging._handlerList:
+        handler = handler()
+        if handler is not None:
+            handler.createLock()
+    _QUARANTINED.clear()
+    with _NEXT_SLOT.get_lock():
+        _slot = _NEXT_SLOT.value % (len(_SLOTS) / 2)
+        _NEXT_SLOT.value += 1
+    rules.TRACE = _trace
+
+
+def _match(task):
+    """Match a chunk of (directory, thing) in a worker, against just the
+    volatile rules if volatile. Returns a list of (rule filename, matches),
+    NEEDS_AUTHOR, or None for things which must be checked by the parent,
+    and the rules quarantined since the last chunk as (directory, rule
+    filename, reason)"""
+    items, profiles, volatile = task
+    now = time.time()
+    for name, created_utc, karma in profiles:
+        AUTHOR_CACHE.put(AuthorProfile(name, created_utc, karma, now))
+    results = []
+    for directory, thing in items:
+        thing = _unpack(thing)
+        ruleset = _RULESETS[directory]
+        if volatile:
+            ruleset = ruleset.volatile()
+        try:
+            rule, matches = ruleset.match(thing, ItemValues(thing))
+        except NeedsParent:
+            results.append(NEEDS_AUTHOR)
+            continue
+        except Exception:
+            results.append(None)
+            continue
+        finally:
+            _SLOTS[2 * _slot + 1] = 0
+        if rule is None:
+            results.append((None, None))
+        else:
+            results.append((rule['_filename'], matches))
+    quarantined = []
+    for directory in set(directory for directory, packed in items):
+        reported = _QUARANTINED.setdefault(directory, set())
+        for filename, reason in _RULESETS[directory].quarantined(
+                ).iteritems():
+            if filename not in reported:
+                reported.add(filename)
+                quarantined.append((directory, filename, reason))
+    return results, quarantined
+
+
+class WorkerPool(object):
+    """
+    Checks things against the rules in a pool of worker processes, so
+    checking uses more than one core, and a rule which takes too long can be
+    stopped.
+
+    The workers are forked with the current RuleSet of every RuleHandler,
+    and are replaced by new ones whenever the rules are reloaded. Things
+    are sent in chunks of at least chunksize (two per worker), along with
+    the cached profiles of their authors, and the first matching rule and
+    its matches are sent back. Sending a thing costs about as much as
+    matching it against a few hundred rules, so lists of fewer than inline
+    things are left to the parent. The authors the
+    workers needed but didn't have are fetched, and their things sent again.
+    If the workers take longer than timeout seconds, all the things are left
+    for the parent to check.
+
+    If a worker spends more than KILL_AFTER seconds on one rule, the workers
+    are killed, the rule is quarantined, and the things are sent to new
+    workers. Rules quarantined by a worker are quarantined in the parent
+    too, so the next workers inherit that.
+    """
+
+    def __init__(self, rulehandlers, processes=None, chunksize=25,
+                 timeout=60, inline=10):
+        self.rulehandlers = set(rulehandlers.itervalues())
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.inline = inline
+        self.timeout = timeout
+        self.stats = dict.fromkeys(('things', 'parent', 'restarts',
+                                    'timeouts', 'kills'), 0)
+        self._pool = None
+        self._rulesets = {}
+        self._rules = {}
+        self._index = []
+        self._slots = None
+
+    def _sync(self):
+        """Start new workers if the rules changed since the workers were
+        started, or there are none"""
+        global _SLOTS, _NEXT_SLOT
+        rulesets = dict((rh.directory, rh.ruleset)
+                        for rh in self.rulehandlers)
+        if self._pool is not None and all(
+                self._rulesets[directory] is ruleset
+                for directory, ruleset in rulesets.iteritems()):
+            return
+        self.close()
+        self._rulesets = rulesets
+        self._rules = dict(
+            (directory, dict((rule['_filename'], rule)
+                             for rule in ruleset.rules + ruleset.author_rules))
+            for directory, ruleset in rulesets.iteritems())
+        self._index = [rule for ruleset in rulesets.itervalues()
+                       for rule in ruleset.rules + ruleset.author_rules]
+        with _FORK_LOCK:
+            _RULESETS.clear()
+            _RULESETS.update(rulesets)
+            _INDEX.clear()
+            _INDEX.update((id(rule), i) for i, rule in enumerate(self._index))
+            _SLOTS = self._slots = multiprocessing.Array(
+                'd', 2 * self.processes, lock=False)
+            _NEXT_SLOT = multiprocessing.Value('i', 0)
+            self._pool = multiprocessing.Pool(self.processes, _init_worker)
+        self.stats['restarts'] += 1
+        logging.info("Started %d workers with rules versions %s" % (
+            self.processes, ", ".join(str(ruleset.version)
+                                      for ruleset in rulesets.itervalues())))
+
+    def _overrun(self):
+        """Get a rule a worker has been matching a thing against for too
+        long, and for how long, or None"""
+        now = time.time()
+        for slot in xrange(self.processes):
+            index = self._slots[2 * slot]
+            started = self._slots[2 * slot + 1]
+            if not started or self._slots[2 * slot] != index:
+                continue
+            rule = self._index[int(index)]
+            if now - started > max(KILL_AFTER, rules.REGEX_BUDGET *
+                                   len(rule.conditions)):
+                return rule, now - started
+        return None
+
+    def match(self, items, volatile=False, fetch=True):
+        """Match a list of (RuleHandler, thing), against just the volatile
+        rules if volatile. Returns a list of (rule, matches), (None, None) if
+        no rule matched, or None if the thing has to be checked by the
+        parent, in the same order. Without fetch, authors which aren't
+        cached aren't fetched, and their things are NEEDS_AUTHOR."""
+        if len(items) < self.inline:
+            self.stats['parent'] += len(items)
+            self.stats['things'] += len(items)
+            return [None] * len(items)
+        results = self._match(items, volatile)
+        again = [i for i, result in enumerate(results)
+                 if fetch and result == NEEDS_AUTHOR]
+        fetched = []
+        for i in again:
+            try:
+                AUTHOR_CACHE.get(items[i][1].author)
+                fetched.append(i)
+            except Exception, e:
+                logging.debug("Failed fetching author of %s: %s" % (
+                    items[i][1].name, e))
+                results[i] = None
+        if fetched:
+            for i, result in zip(fetched, self._match(
+                    [items[i] for i in fetched], volatile)):
+                results[i] = None if result == NEEDS_AUTHOR else result
+        self.stats['parent'] += sum(1 for result in results if result is None)
+        self.stats['things'] += len(items)
+        return results
+
+    def _match(self, items, volatile):
+        """Match items in the workers, once. Things which need an author
+        which isn't cached are NEEDS_AUTHOR."""
+        tasks = []
+        size = max(self.chunksize, -(-len(items) // (2 * self.processes)))
+        for i in xrange(0, len(items), size):
+            chunk = items[i:i + size]
+            profiles = {}
+            for rulehandler, thing in chunk:
+                author = getattr(thing, 'author', None)
+                if author is None or author.name in profiles:
+                    continue
+                profile = AUTHOR_CACHE.peek(author.name)
+                if profile is not None:
+                    profiles[author.name] = (profile.name,
+                                             profile.created_utc,
+                                             profile.karma)
+            tasks.append(([(rulehandler.directory, _pack(thing))
+                           for rulehandler, thing in chunk],
+                          profiles.values(), volatile))
+        while True:
+            self._sync()
+            pending = self._pool.map_async(_match, tasks)
+            deadline = time.time() + self.timeout
+            overrun = None
+            while not pending.ready() and time.time() < deadline:
+                pending.wait(WATCH_INTERVAL)
+                overrun = self._overrun()
+                if overrun is not None:
+                    break
+            if overrun is None:
+                break
+            rule, seconds = overrun
+            rule.quarantine("stopped after %.3f seconds on one thing" %
+                            seconds)
+            self.stats['kills'] += 1
+            # The new workers inherit the quarantine, and start over
+            self.close()
+        if not pending.ready():
+            logging.error("Workers took more than %d seconds, checking %d "
+                          "things in the main process" % (self.timeout,
+                                                          len(items)))
+            self.stats['timeouts'] += 1
+            # They may be stuck, start new ones next time
+            self.close()
+            return [None] * len(items)
+        chunks = pending.get()
+        for chunk, quarantined in chunks:
+            for directory, filename, reason in quarantined:
+                rule = self._rules[directory].get(filename)
+                if rule is not None:
+                    # Already logged by the worker
+                    rule.quarantined = reason
+        results = []
+        for (rulehandler, thing), result in zip(
+                items, (result for chunk, quarantined in chunks
+                        for result in chunk)):
+            if result is not None and result != NEEDS_AUTHOR and \
+                    result[0] is not None:
+                by_filename = self._rules[rulehandler.directory]
+                result = (by_filename[result[0]], result[1])
+            results.append(result)
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None